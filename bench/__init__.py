@@ -0,0 +1,7 @@
+"""
+Benchmarks for crispin.
+
+Run with `python -m bench -h` from the repository root. Every benchmark
+works on a synthetic cookbook written to a temporary directory and prints
+its results as JSON so runs from different commits can be compared.
+"""
@@ -0,0 +1,75 @@
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from bench.cookbook import make_cookbook
+from bench.server import bench_keepalive, bench_server, free_port, start_server
+from bench.stages import bench_stages
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m bench", description="Benchmark crispin against a synthetic cookbook.")
+    parser.add_argument("--recipes", type=int, default=10, help="Number of recipes in the cookbook.")
+    parser.add_argument("--fragments", type=int, default=20, help="Number of fragments per recipe.")
+    parser.add_argument("--variables", type=int, default=50, help="Number of variables in the answers.")
+    parser.add_argument("--depth", type=int, default=3, help="How deep the dotted variables are nested.")
+    parser.add_argument("--hosts", type=int, default=5, help="Number of answer files per recipe.")
+    parser.add_argument("--repeat", type=int, default=20, help="Runs per stage.")
+    parser.add_argument("--clients", type=int, default=8, help="Concurrent clients for the server benchmark.")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds to run the server benchmark for.")
+    parser.add_argument("--sequential", type=int, default=200, help="Requests made one after the other by a single client for the keep-alive benchmark.")
+    parser.add_argument("--no-server", action="store_true", help="Skip the server benchmark.")
+    parser.add_argument("-o", "--output", type=str, help="Write the JSON results here instead of stdout.")
+    args = parser.parse_args()
+
+    results = {
+        "revision": git_revision(),
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "parameters": {
+            key: getattr(args, key)
+            for key in ("recipes", "fragments", "variables", "depth", "hosts", "repeat", "clients", "duration", "sequential")
+        },
+    }
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cookbook_dir = Path(tmpdir) / "cookbook"
+        ipxe_dir = Path(tmpdir) / "ipxe"
+        ipxe_dir.mkdir()
+        answer_names = make_cookbook(
+            cookbook_dir, args.recipes, args.fragments, args.variables, args.depth, args.hosts
+        )
+        results["stages"] = bench_stages(cookbook_dir, answer_names[0], args.repeat)
+
+        if not args.no_server:
+            port = free_port()
+            proc = start_server(cookbook_dir, ipxe_dir, port)
+            try:
+                results["server"] = bench_server(port, answer_names, args.clients, args.duration)
+                results["keepalive"] = bench_keepalive(port, answer_names, args.sequential)
+            finally:
+                proc.terminate()
+                proc.wait()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,70 @@
+import json
+from pathlib import Path
+
+
+def _variable(i: int, depth: int):
+    # Spread the variables over a few top level keys and nest them depth deep
+    parts = [f"group{i % 8}"] + [f"level{d}" for d in range(1, depth)] + [f"var{i}"]
+    return ".".join(parts)
+
+
+def _set_path(answers: dict, path: str, value):
+    keys = path.split(".")
+    for key in keys[:-1]:
+        answers = answers.setdefault(key, {})
+    answers[keys[-1]] = value
+
+
+def make_cookbook(path, recipes: int = 10, fragments: int = 20, variables: int = 50, depth: int = 3, hosts: int = 1, fragment_lines: int = 40):
+    """
+    Writes a synthetic cookbook to path and returns the names of the answer
+    files in it.
+
+    Every recipe uses `fragments` fragments out of a shared pool, every
+    fragment uses a slice of `variables` dotted variables nested `depth`
+    deep as well as a loop and a %post section, and every recipe gets
+    `hosts` answer files.
+    """
+    path = Path(path)
+    answers_dir = path / "answers"
+    recipes_dir = path / "recipes"
+    templates_dir = path / "templates"
+    for directory in (answers_dir, recipes_dir, templates_dir):
+        directory.mkdir(parents=True, exist_ok=True)
+
+    names = [_variable(i, depth) for i in range(variables)]
+    pool = recipes + fragments
+    for f in range(pool):
+        group_dir = templates_dir / f"group{f % 5}"
+        group_dir.mkdir(exist_ok=True)
+        lines = [f"# fragment {f}"]
+        for line in range(fragment_lines):
+            lines.append(f"option{line} --value={{{{ {names[(f + line) % variables]} }}}}")
+        lines.append("{% for pkg in packages %}package {{ pkg.name }}-{{ pkg.version }}")
+        lines.append("{% endfor %}")
+        lines.append(f"%post")
+        lines.append(f"echo fragment {f} {{{{ {names[f % variables]} }}}}")
+        lines.append("%end")
+        (group_dir / f"fragment{f}.ks").write_text("\n".join(lines) + "\n")
+
+    answer_names = []
+    for r in range(recipes):
+        recipe = {}
+        for f in range(r, r + fragments):
+            recipe.setdefault(f"group{f % 5}", []).append(f"fragment{f}.ks")
+        (recipes_dir / f"recipe{r}.json").write_text(
+            json.dumps({"name": f"recipe{r}", "recipe": recipe}, indent=2)
+        )
+
+        for h in range(hosts):
+            answer_name = f"recipe{r}-host{h}"
+            answers = {
+                "metadata": {"recipe": f"recipe{r}", "source": "http://mirror.example/os/"},
+                "packages": [{"name": f"pkg{p}", "version": f"1.{p}"} for p in range(10)],
+            }
+            for name in names:
+                _set_path(answers, name, f"{name}-{h}")
+            (answers_dir / f"{answer_name}.json").write_text(json.dumps(answers, indent=2))
+            answer_names.append(answer_name)
+
+    return answer_names
@@ -0,0 +1,266 @@
+"""
+Simulates a PXE storm against `crispin serve`.
+
+Every simulated host replays the requests of a real network install: the
+iPXE menu, the kernel and initrd and then the kickstart, which Anaconda may
+fetch again. Hosts arrive following a configurable curve and the results
+are reported per route as JSON.
+
+    python -m bench.pxestorm --clients 500 --arrival ramp --spread 20
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+from urllib.parse import urlsplit
+from bench.cookbook import make_cookbook
+from bench.server import free_port, start_server
+from bench.stages import summarize
+
+
+class RouteStats:
+
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.bytes = 0
+        self.statuses = {}
+
+    def report(self, elapsed):
+        report = summarize(self.latencies) if self.latencies else {}
+        report.update(
+            {
+                "requests": len(self.latencies) + self.errors,
+                "errors": self.errors,
+                "error_rate": self.errors / max(1, len(self.latencies) + self.errors),
+                "bytes": self.bytes,
+                "bytes_per_sec": self.bytes / elapsed,
+                "statuses": self.statuses,
+            }
+        )
+        return report
+
+
+def arrival_offsets(clients: int, curve: str, spread: float, seed: int = 0):
+    """
+    Returns the second at which each client boots.
+
+    burst: everyone at once. constant: evenly spaced over spread seconds.
+    ramp: arrival rate grows linearly over spread seconds. poisson:
+    exponentially distributed gaps averaging spread / clients.
+    """
+    rng = random.Random(seed)
+    match curve:
+        case "burst":
+            return [0.0] * clients
+        case "constant":
+            return [spread * i / clients for i in range(clients)]
+        case "ramp":
+            # The i-th arrival of a linearly growing rate lands at sqrt(i/n)
+            return [spread * (i / clients) ** 0.5 for i in range(clients)]
+        case "poisson":
+            offsets, now = [], 0.0
+            for _ in range(clients):
+                offsets.append(now)
+                now += rng.expovariate(clients / spread) if spread > 0 else 0.0
+            return offsets
+        case _:
+            raise ValueError(f"Unknown arrival curve {curve}")
+
+
+class Connection:
+    """
+    A minimal keep-alive HTTP/1.1 client connection for asyncio.
+    """
+
+    def __init__(self, host, port, timeout):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+        self.reader = self.writer = None
+
+    async def get(self, path):
+        """
+        Fetches path and returns the status and the number of body bytes.
+        """
+        return await asyncio.wait_for(self._get(path), self.timeout)
+
+    async def _get(self, path):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.writer.write(
+            f"GET {path} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\nUser-Agent: pxestorm\r\n\r\n".encode()
+        )
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError("Server closed the connection")
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        received = 0
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            while True:
+                size = int((await self.reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    await self.reader.readline()
+                    break
+                received += len(await self.reader.readexactly(size))
+                await self.reader.readline()
+        elif "content-length" in headers:
+            length = int(headers["content-length"])
+            while received < length:
+                chunk = await self.reader.read(min(1024 * 1024, length - received))
+                if not chunk:
+                    raise ConnectionError("Body cut short")
+                received += len(chunk)
+        elif status not in (204, 304):
+            while chunk := await self.reader.read(1024 * 1024):
+                received += len(chunk)
+            await self.close()
+
+        if headers.get("connection", "").lower() == "close":
+            await self.close()
+        return status, received
+
+
+async def boot_host(host, port, answer_name, args, stats):
+    conn = Connection(host, port, args.timeout)
+    routes = [
+        ("autoexec.ipxe", "/autoexec.ipxe"),
+        ("vmlinuz", args.kernel_path),
+        ("initrd.img", args.initrd_path),
+        ("kickstart", f"/crispin/get/{answer_name}"),
+    ]
+    if random.random() < args.retry_rate:
+        routes.append(("kickstart", f"/crispin/get/{answer_name}"))
+
+    try:
+        for route, path in routes:
+            start = time.perf_counter()
+            try:
+                status, received = await conn.get(path)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError, IndexError):
+                stats[route].errors += 1
+                await conn.close()
+                continue
+            stats[route].statuses[status] = stats[route].statuses.get(status, 0) + 1
+            stats[route].bytes += received
+            if status >= 400:
+                stats[route].errors += 1
+            else:
+                stats[route].latencies.append(time.perf_counter() - start)
+    finally:
+        await conn.close()
+
+
+async def storm(host, port, answer_names, args):
+    stats = {route: RouteStats() for route in ("autoexec.ipxe", "vmlinuz", "initrd.img", "kickstart")}
+    offsets = arrival_offsets(args.clients, args.arrival, args.spread, args.seed)
+    start = time.perf_counter()
+
+    async def delayed(i, offset):
+        await asyncio.sleep(max(0.0, offset - (time.perf_counter() - start)))
+        await boot_host(host, port, answer_names[i % len(answer_names)], args, stats)
+
+    await asyncio.gather(*(delayed(i, offset) for i, offset in enumerate(offsets)))
+    elapsed = time.perf_counter() - start
+
+    requests = sum(len(s.latencies) + s.errors for s in stats.values())
+    errors = sum(s.errors for s in stats.values())
+    total_bytes = sum(s.bytes for s in stats.values())
+    return {
+        "clients": args.clients,
+        "arrival": args.arrival,
+        "spread": args.spread,
+        "elapsed_sec": elapsed,
+        "requests": requests,
+        "errors": errors,
+        "error_rate": errors / max(1, requests),
+        "requests_per_sec": requests / elapsed,
+        "bytes": total_bytes,
+        "bytes_per_sec": total_bytes / elapsed,
+        "routes": {route: s.report(elapsed) for route, s in stats.items()},
+    }
+
+
+def _write_image(path, size):
+    chunk = bytes(range(256)) * 4096
+    with open(path, "wb") as f:
+        remaining = size
+        while remaining > 0:
+            remaining -= f.write(chunk[:remaining])
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m bench.pxestorm", description="Simulate many hosts network booting from crispin at once.")
+    parser.add_argument("--clients", type=int, default=200, help="Number of simulated hosts.")
+    parser.add_argument("--arrival", choices=("burst", "constant", "ramp", "poisson"), default="burst", help="How host boots are spread over time.")
+    parser.add_argument("--spread", type=float, default=10.0, help="Seconds the arrivals are spread over.")
+    parser.add_argument("--retry-rate", type=float, default=0.1, help="Fraction of hosts that fetch their kickstart twice.")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Seconds before a single request counts as failed.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for arrivals and retries.")
+    parser.add_argument("--kernel-path", type=str, default="/vmlinuz", help="Path of the kernel on the server.")
+    parser.add_argument("--initrd-path", type=str, default="/initrd.img", help="Path of the initrd on the server.")
+    parser.add_argument("--url", type=str, help="Storm an already running server instead of starting one.")
+    parser.add_argument("--answers", type=str, nargs="+", help="Answer names to fetch with --url.")
+    parser.add_argument("--kernel-size", type=int, default=16 * 1024 * 1024, help="Bytes in the throwaway vmlinuz.")
+    parser.add_argument("--initrd-size", type=int, default=64 * 1024 * 1024, help="Bytes in the throwaway initrd.img.")
+    parser.add_argument("--recipes", type=int, default=5, help="Recipes in the throwaway cookbook.")
+    parser.add_argument("--hosts", type=int, default=20, help="Answer files per recipe in the throwaway cookbook.")
+    parser.add_argument("--server-args", type=str, default="", help="Extra keyword arguments for CrispinServe.run, e.g. ', threads=32'.")
+    parser.add_argument("-o", "--output", type=str, help="Write the JSON results here instead of stdout.")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    if args.url:
+        if not args.answers:
+            parser.error("--answers is required with --url")
+        url = urlsplit(args.url)
+        results = asyncio.run(storm(url.hostname, url.port or 80, args.answers, args))
+    else:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cookbook_dir = Path(tmpdir) / "cookbook"
+            ipxe_dir = Path(tmpdir) / "ipxe"
+            ipxe_dir.mkdir()
+            _write_image(ipxe_dir / args.kernel_path.lstrip("/"), args.kernel_size)
+            _write_image(ipxe_dir / args.initrd_path.lstrip("/"), args.initrd_size)
+            answer_names = make_cookbook(cookbook_dir, recipes=args.recipes, hosts=args.hosts)
+            port = free_port()
+            proc = start_server(cookbook_dir, ipxe_dir, port, args.server_args)
+            try:
+                results = asyncio.run(storm("127.0.0.1", port, answer_names, args))
+            finally:
+                proc.terminate()
+                proc.wait()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,123 @@
+import http.client
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from bench.stages import summarize
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(cookbook_dir, ipxe_dir, port, extra_args=""):
+    """
+    Starts `CrispinServe.run` in a child process and waits for it to listen.
+    """
+    code = (
+        "from crispin.CrispinServe import run; "
+        f"run(port={port}, cookbook_dir={str(cookbook_dir)!r}, ipxe_dir={str(ipxe_dir)!r}{extra_args})"
+    )
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    proc = subprocess.Popen(
+        [sys.executable, "-c", code], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return proc
+        except OSError:
+            if proc.poll() is not None:
+                raise RuntimeError(f"crispin serve exited with {proc.returncode}")
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("crispin serve did not start listening")
+
+
+def bench_server(port, answer_names, clients: int = 8, duration: float = 10.0):
+    """
+    Fetches kickstarts from a running server with `clients` keep-alive
+    connections for `duration` seconds and reports throughput and latency.
+    """
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    stop_at = time.monotonic() + duration
+
+    def client(offset):
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        mine, failed = [], 0
+        i = offset
+        while time.monotonic() < stop_at:
+            path = f"/crispin/get/{answer_names[i % len(answer_names)]}"
+            i += 1
+            start = time.perf_counter()
+            try:
+                conn.request("GET", path)
+                response = conn.getresponse()
+                response.read()
+                if response.status != 200:
+                    failed += 1
+                mine.append(time.perf_counter() - start)
+            except (OSError, http.client.HTTPException):
+                failed += 1
+                conn.close()
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        conn.close()
+        with lock:
+            latencies.extend(mine)
+            errors.append(failed)
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(clients)]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+
+    results = summarize(latencies) if latencies else {}
+    results["requests"] = len(latencies)
+    results["errors"] = sum(errors)
+    results["requests_per_sec"] = len(latencies) / elapsed
+    results["clients"] = clients
+    return results
+
+
+def bench_keepalive(port, answer_names, requests: int = 200):
+    """
+    Fetches kickstarts one after the other from a single client, once
+    reusing one keep-alive connection and once opening a connection per
+    request, and reports the latency of each.
+    """
+    results = {}
+    for mode in ("reused", "new"):
+        latencies = []
+        errors = 0
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        for i in range(requests):
+            if mode == "new":
+                conn.close()
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+            start = time.perf_counter()
+            try:
+                conn.request("GET", f"/crispin/get/{answer_names[i % len(answer_names)]}")
+                response = conn.getresponse()
+                response.read()
+                if response.status != 200:
+                    errors += 1
+                latencies.append(time.perf_counter() - start)
+            except (OSError, http.client.HTTPException):
+                errors += 1
+                conn.close()
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        conn.close()
+        results[mode] = summarize(latencies) if latencies else {}
+        results[mode]["requests"] = len(latencies)
+        results[mode]["errors"] = errors
+    return results
@@ -0,0 +1,80 @@
+import json
+import statistics
+import tempfile
+import time
+from pathlib import Path
+from jinja2 import Environment
+from crispin.CrispinAnalyze import find_template_vars
+from crispin.CrispinGenerate import (
+    CompiledRecipe,
+    build_compiled_recipe,
+    fragment_cache,
+    generate_empty_answers,
+    generate_template,
+    load_recipe,
+    write_file,
+)
+
+
+def summarize(samples):
+    """
+    Summarizes a list of durations in seconds as milliseconds.
+    """
+    ordered = sorted(samples)
+    return {
+        "runs": len(ordered),
+        "min_ms": ordered[0] * 1000,
+        "p50_ms": statistics.median(ordered) * 1000,
+        "p99_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000,
+        "mean_ms": statistics.fmean(ordered) * 1000,
+    }
+
+
+def time_stage(fn, repeat: int, setup=None):
+    samples = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+
+def bench_stages(cookbook_dir, answer_name: str, repeat: int = 20):
+    """
+    Times every stage of turning an answers file into a kickstart on its own.
+    """
+    cookbook_dir = Path(cookbook_dir)
+    answer_file = cookbook_dir / "answers" / (answer_name + ".json")
+    answers = json.loads(answer_file.read_text())
+    recipe_file = cookbook_dir / "recipes" / (answers["metadata"]["recipe"] + ".json")
+    template_dir = cookbook_dir / "templates"
+
+    source = generate_template(recipe_file, template_dir)
+    compiled = CompiledRecipe(source, ())
+    kickstart = compiled.template.render(answers)
+    env = Environment()
+
+    results = {
+        "recipe_load": time_stage(lambda: load_recipe(recipe_file), repeat),
+        "generate_template_cold": time_stage(
+            lambda: generate_template(recipe_file, template_dir), repeat, setup=fragment_cache.clear
+        ),
+        "generate_template_warm": time_stage(lambda: generate_template(recipe_file, template_dir), repeat),
+        "compile": time_stage(lambda: CompiledRecipe(source, ()), repeat),
+        # Fragments stay compiled in the shared environment, so this is the
+        # cost of another recipe built from the same fragments.
+        "compile_composed": time_stage(lambda: build_compiled_recipe(recipe_file, template_dir), repeat),
+        "find_all_vars": time_stage(lambda: find_template_vars(env.parse(source), env), repeat),
+        "generate_empty_answers": time_stage(lambda: generate_empty_answers(compiled), repeat),
+        "check_answers": time_stage(lambda: compiled.schema.validate(answers), repeat),
+        "render": time_stage(lambda: compiled.template.render(answers), repeat),
+    }
+    with tempfile.TemporaryDirectory() as output_dir:
+        results["write_file"] = time_stage(lambda: write_file(kickstart, output_dir, "bench.ks"), repeat)
+
+    results["template_bytes"] = len(source)
+    results["kickstart_bytes"] = len(kickstart)
+    results["variables"] = len(compiled.variables)
+    return results
@@ -0,0 +1,141 @@
+"""
+Measures the built in TFTP server over loopback.
+
+Every client downloads the same file at the same time with the given block
+and window size and the transfer rate is reported as JSON. With no --root
+a throwaway file of --size bytes is served.
+
+    python -m bench.tftp --clients 20 --blksize 1468 --windowsize 16
+"""
+import argparse
+import asyncio
+import json
+import struct
+import sys
+import tempfile
+import time
+from pathlib import Path
+from bench.stages import summarize
+from crispin.CrispinTFTP import ACK, DATA, ERROR, OACK, RRQ, TFTPServer
+
+
+class _Client(asyncio.DatagramProtocol):
+
+    def __init__(self):
+        self.packets = asyncio.Queue()
+
+    def datagram_received(self, data, addr):
+        self.packets.put_nowait((data, addr))
+
+
+async def fetch(host, port, filename, blksize=None, windowsize=None, timeout=5.0):
+    """
+    Downloads filename over TFTP and returns its contents, acknowledging
+    every windowsize blocks as RFC 7440 describes.
+    """
+    loop = asyncio.get_running_loop()
+    transport, client = await loop.create_datagram_endpoint(_Client, local_addr=("127.0.0.1", 0))
+    try:
+        options = {"tsize": "0"}
+        if blksize:
+            options["blksize"] = str(blksize)
+        if windowsize:
+            options["windowsize"] = str(windowsize)
+        request = struct.pack("!H", RRQ) + f"{filename}\0octet\0".encode()
+        request += b"".join(f"{name}\0{value}\0".encode() for name, value in options.items())
+        transport.sendto(request, (host, port))
+
+        negotiated_blksize = 512
+        negotiated_windowsize = 1
+        received = []
+        expected = 1
+        server = None
+        while True:
+            data, addr = await asyncio.wait_for(client.packets.get(), timeout)
+            server = server or addr
+            opcode = struct.unpack("!H", data[:2])[0]
+            if opcode == ERROR:
+                raise OSError(f"TFTP error {struct.unpack('!H', data[2:4])[0]}: {data[4:-1].decode()}")
+            if opcode == OACK:
+                fields = data[2:].split(b"\0")[:-1]
+                accepted = dict(zip(fields[::2], fields[1::2]))
+                negotiated_blksize = int(accepted.get(b"blksize", 512))
+                negotiated_windowsize = int(accepted.get(b"windowsize", 1))
+                transport.sendto(struct.pack("!HH", ACK, 0), server)
+                continue
+            if opcode != DATA:
+                continue
+            block = struct.unpack("!H", data[2:4])[0]
+            if block != expected & 0xFFFF:
+                # Out of order, ask for everything after the last good block
+                transport.sendto(struct.pack("!HH", ACK, (expected - 1) & 0xFFFF), server)
+                continue
+            payload = data[4:]
+            received.append(payload)
+            last = len(payload) < negotiated_blksize
+            if last or expected % negotiated_windowsize == 0:
+                transport.sendto(struct.pack("!HH", ACK, block), server)
+            if last:
+                return b"".join(received)
+            expected += 1
+    finally:
+        transport.close()
+
+
+async def bench_tftp(root, filename, clients, blksize, windowsize):
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: TFTPServer(root, max_blksize=65464, max_windowsize=65535), local_addr=("127.0.0.1", 0)
+    )
+    port = transport.get_extra_info("sockname")[1]
+    size = (Path(root) / filename).stat().st_size
+    latencies = []
+
+    async def one():
+        start = time.perf_counter()
+        data = await fetch("127.0.0.1", port, filename, blksize, windowsize)
+        if len(data) != size:
+            raise ValueError(f"Got {len(data)} bytes, expected {size}")
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*(one() for _ in range(clients)))
+    finally:
+        transport.close()
+    elapsed = time.perf_counter() - start
+    report = summarize(latencies)
+    report.update(
+        {
+            "clients": clients,
+            "blksize": blksize or 512,
+            "windowsize": windowsize or 1,
+            "file_bytes": size,
+            "elapsed_sec": elapsed,
+            "bytes_per_sec": size * clients / elapsed,
+        }
+    )
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m bench.tftp", description="Benchmark the built in TFTP server over loopback.")
+    parser.add_argument("--clients", type=int, default=10, help="Concurrent downloads.")
+    parser.add_argument("--blksize", type=int, default=None, help="blksize option to request, none by default.")
+    parser.add_argument("--windowsize", type=int, default=None, help="windowsize option to request, none by default.")
+    parser.add_argument("--root", type=str, help="Directory to serve instead of a throwaway one.")
+    parser.add_argument("--file", type=str, default="initrd.img", help="File to download.")
+    parser.add_argument("--size", type=int, default=8 * 1024 * 1024, help="Bytes in the throwaway file.")
+    args = parser.parse_args()
+
+    if args.root:
+        results = asyncio.run(bench_tftp(args.root, args.file, args.clients, args.blksize, args.windowsize))
+    else:
+        with tempfile.TemporaryDirectory() as root:
+            (Path(root) / args.file).write_bytes(bytes(range(256)) * (args.size // 256) + b"x" * (args.size % 256))
+            results = asyncio.run(bench_tftp(root, args.file, args.clients, args.blksize, args.windowsize))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,22 +1,52 @@
+import itertools
 import json
 from pathlib import Path
-from crispin.CrispinGenerate import generate_template, generate_kickstart, generate_kickstart_from_answers_dict
+from crispin.CrispinCatalog import answers_catalog
+from crispin.CrispinCache import LRUCache, is_fresh
+from crispin.CrispinEncoding import EncodedBody
+from crispin.CrispinGenerate import compile_recipe, render_kickstart, stream_kickstart, generate_kickstart_from_answers_dict
 
-def get_kickstart(answer_name, cookbook_dir):
+
+class RenderedKickstart(EncodedBody):
     """
-    Generates a kickstart file using a pre-existing answers file.
+    A kickstart rendered from an answers file, kept with the fingerprint of
+    every file it was rendered from, an ETag of its contents and any
+    compressed variants sent so far.
+
+    render_cache counts the variants towards its size, so the entry is
+    weighed again under cache_key whenever one is added.
     """
-    cookbook_dir = Path(cookbook_dir)
-    answers_dir = cookbook_dir / "answers"
-    answer_file = answers_dir / (answer_name + ".json")
 
-    if not answer_file.exists():
-        raise FileNotFoundError(f"Answer file not found at {answer_file}")
+    __slots__ = ("fingerprint", "cache_key")
+
+    def __init__(self, kickstart, fingerprint, cache_key=None):
+        super().__init__(kickstart)
+        self.fingerprint = fingerprint
+        self.cache_key = cache_key
+
+    def encoded(self, encoding):
+        added = encoding is not None and encoding not in self._variants
+        variant = super().encoded(encoding)
+        if added and self.cache_key is not None and encoding in self._variants:
+            render_cache.reweigh(self.cache_key, self)
+        return variant
 
-    with open(answer_file, "r") as f:
-        answers = json.load(f)
 
-    recipe_name = answers.get("metadata").get("recipe")
+# Kickstarts rendered from answer files only change when the answers, recipe
+# or a fragment change so repeat requests are served from here.
+render_cache = LRUCache("render", maxsize=4096, maxbytes=64 * 1024 * 1024, weigh=lambda entry: entry.size)
+
+
+# Kickstarts larger than this are streamed as they render and not kept in
+# render_cache.
+MAX_CACHED_KICKSTART = 1024 * 1024
+
+
+def _load_answers(answer_name, cookbook_dir):
+    cookbook_dir = Path(cookbook_dir)
+    record = answers_catalog(cookbook_dir).get(answer_name)
+
+    recipe_name = record.recipe
     if not recipe_name:
         raise ValueError("Recipe not specified in answers file")
 
@@ -25,10 +55,78 @@ def get_kickstart(answer_name, cookbook_dir):
         raise FileNotFoundError(f"Recipe file not found at {recipe_file}")
 
     template_dir = cookbook_dir / "templates"
-    generated_template = generate_template(recipe_file, template_dir)
-    kickstart = generate_kickstart(generated_template, str(answer_file))
+    compiled = compile_recipe(recipe_file, template_dir)
+    answer_file = cookbook_dir / "answers" / (answer_name + ".json")
+    return answer_file, record.answers, compiled, record.fingerprint + compiled.fingerprint
 
-    return kickstart
+
+def _cached_kickstart(answer_name, cookbook_dir):
+    answer_file = Path(cookbook_dir) / "answers" / (answer_name + ".json")
+    return render_cache.get(str(answer_file), valid=lambda rendered: is_fresh(rendered.fingerprint))
+
+
+def get_rendered_kickstart(answer_name, cookbook_dir):
+    """
+    Returns the RenderedKickstart for a pre-existing answers file, rendering
+    it only if it is not cached or any file it was rendered from has changed.
+    """
+    rendered = _cached_kickstart(answer_name, cookbook_dir)
+    if rendered is not None:
+        return rendered
+
+    answer_file, answers, compiled, fingerprint = _load_answers(answer_name, cookbook_dir)
+    kickstart = render_kickstart(compiled, answers)
+
+    rendered = RenderedKickstart(kickstart, fingerprint, str(answer_file))
+    render_cache.put(rendered.cache_key, rendered)
+    return rendered
+
+
+def answer_recipe(answer_name, cookbook_dir):
+    """
+    Returns the recipe named in an answers file's metadata, or None.
+    """
+    try:
+        return answers_catalog(cookbook_dir).get(answer_name).recipe
+    except (OSError, ValueError):
+        return None
+
+
+def open_kickstart(answer_name, cookbook_dir, cached: bool = True):
+    """
+    Returns the RenderedKickstart for a pre-existing answers file, from
+    render_cache if there is a fresh one or rendered and added to it. A
+    kickstart larger than MAX_CACHED_KICKSTART is not kept whole, a
+    generator streaming it as utf-8 chunks is returned instead. With cached
+    set to False the kickstart is always rendered.
+    """
+    if cached:
+        rendered = _cached_kickstart(answer_name, cookbook_dir)
+        if rendered is not None:
+            return rendered
+
+    answer_file, answers, compiled, fingerprint = _load_answers(answer_name, cookbook_dir)
+    chunks = stream_kickstart(compiled, answers)
+
+    kept = []
+    size = 0
+    for chunk in chunks:
+        kept.append(chunk)
+        size += len(chunk)
+        if size > MAX_CACHED_KICKSTART:
+            # What was rendered so far goes out first, then the rest as it renders
+            return itertools.chain(kept, chunks)
+
+    rendered = RenderedKickstart(b"".join(kept), fingerprint, str(answer_file))
+    render_cache.put(rendered.cache_key, rendered)
+    return rendered
+
+
+def get_kickstart(answer_name, cookbook_dir):
+    """
+    Generates a kickstart file using a pre-existing answers file.
+    """
+    return get_rendered_kickstart(answer_name, cookbook_dir).text
 
 def post_kickstart(recipe_name, answers, cookbook_dir):
     """
@@ -46,10 +144,31 @@ def post_kickstart(recipe_name, answers, cookbook_dir):
         raise ValueError("Invalid JSON in request body")
 
     template_dir = cookbook_dir / "templates"
-    generated_template = generate_template(recipe_file, template_dir)
-    kickstart, error = generate_kickstart_from_answers_dict(generated_template, answers_dict)
+    compiled = compile_recipe(recipe_file, template_dir)
+    kickstart, error = generate_kickstart_from_answers_dict(compiled, answers_dict)
 
     if error:
         raise ValueError(error)
 
     return kickstart
+
+
+def stream_post_kickstart(recipe_name, answers, cookbook_dir):
+    """
+    Like post_kickstart but returns a generator of the kickstart as utf-8
+    chunks. Invalid or incomplete answers raise ValueError before streaming.
+    """
+    cookbook_dir = Path(cookbook_dir)
+    recipe_file = cookbook_dir / "recipes" / (recipe_name + ".json")
+
+    if not recipe_file.exists():
+        raise FileNotFoundError(f"Recipe file not found at {recipe_file}")
+
+    try:
+        answers_dict = json.loads(answers)
+    except json.JSONDecodeError:
+        raise ValueError("Invalid JSON in request body")
+
+    template_dir = cookbook_dir / "templates"
+    compiled = compile_recipe(recipe_file, template_dir)
+    return stream_kickstart(compiled, answers_dict)
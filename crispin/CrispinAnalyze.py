@@ -0,0 +1,177 @@
+from jinja2 import nodes
+from jinja2.visitor import NodeVisitor
+
+
+class VariableCollector(NodeVisitor):
+    """
+    Walks a parsed Jinja2 template and collects the dotted path of every
+    variable the template expects to be supplied.
+
+    `{{ net.ip }}` yields both `net` and `net.ip`. Names bound inside the
+    template (loop targets, `set`, macro arguments, imports, ...) are not
+    collected, nor are attributes read through them.
+
+    found maps each path to whether it is required. A path only used in the
+    branches of an `if` or an inline `x if y else z` may never be rendered,
+    so it is optional unless it is also used outside of one.
+    """
+
+    def __init__(self, ignore=()):
+        # dict keys keep the paths in the order they appear in the template
+        self.found = {}
+        self.scopes = [set(ignore)]
+        self.conditional = 0
+
+    def _is_local(self, name):
+        return any(name in scope for scope in self.scopes)
+
+    def _bind(self, target):
+        for name_node in target.find_all(nodes.Name):
+            self.scopes[-1].add(name_node.name)
+        if isinstance(target, nodes.Name):
+            self.scopes[-1].add(target.name)
+
+    def _collect(self, parts):
+        required = not self.conditional
+        for i in range(1, len(parts) + 1):
+            path = ".".join(parts[:i])
+            self.found[path] = self.found.get(path, False) or required
+
+    def _visit_branches(self, *branches):
+        self.conditional += 1
+        for branch in branches:
+            for child in branch:
+                self.visit(child)
+        self.conditional -= 1
+
+    def _visit_chain(self, node):
+        parts = []
+        base = node
+        while True:
+            if isinstance(base, nodes.Getattr):
+                parts.append(base.attr)
+                base = base.node
+            elif (
+                isinstance(base, nodes.Getitem)
+                and isinstance(base.arg, nodes.Const)
+                and isinstance(base.arg.value, str)
+            ):
+                parts.append(base.arg.value)
+                base = base.node
+            else:
+                break
+
+        if isinstance(base, nodes.Name) and base.ctx == "load":
+            if not self._is_local(base.name):
+                parts.append(base.name)
+                self._collect(parts[::-1])
+        else:
+            self.visit(base)
+
+    def visit_Name(self, node):
+        if node.ctx == "load" and not self._is_local(node.name):
+            self._collect([node.name])
+
+    def visit_Getattr(self, node):
+        self._visit_chain(node)
+
+    def visit_Getitem(self, node):
+        if isinstance(node.arg, nodes.Const) and isinstance(node.arg.value, str):
+            self._visit_chain(node)
+        else:
+            self.visit(node.node)
+            self.visit(node.arg)
+
+    def visit_Call(self, node):
+        # foo.items() is a method of foo, not a variable called foo.items
+        if isinstance(node.node, nodes.Getattr):
+            self._visit_chain(node.node.node)
+        else:
+            self.visit(node.node)
+        for child in (*node.args, *node.kwargs, node.dyn_args, node.dyn_kwargs):
+            if child is not None:
+                self.visit(child)
+
+    def visit_If(self, node):
+        # The test of the first branch is always evaluated, elif tests are
+        # only reached when the branches before them were not taken.
+        self.visit(node.test)
+        self._visit_branches(node.body, node.elif_, node.else_)
+
+    def visit_CondExpr(self, node):
+        self.visit(node.test)
+        self._visit_branches([node.expr1], [node.expr2] if node.expr2 is not None else [])
+
+    def visit_For(self, node):
+        self.visit(node.iter)
+        self.scopes.append({"loop"})
+        self._bind(node.target)
+        if node.test is not None:
+            self.visit(node.test)
+        for child in node.body:
+            self.visit(child)
+        self.scopes.pop()
+        for child in node.else_:
+            self.visit(child)
+
+    def visit_Assign(self, node):
+        self.visit(node.node)
+        if isinstance(node.target, nodes.NSRef):
+            self.visit(nodes.Name(node.target.name, "load"))
+        else:
+            self._bind(node.target)
+
+    def visit_AssignBlock(self, node):
+        for child in node.body:
+            self.visit(child)
+        if node.filter is not None:
+            self.visit(node.filter)
+        self._bind(node.target)
+
+    def _visit_callable(self, node, local_names):
+        for default in node.defaults:
+            self.visit(default)
+        self.scopes.append(set(local_names))
+        for arg in node.args:
+            self._bind(arg)
+        for child in node.body:
+            self.visit(child)
+        self.scopes.pop()
+
+    def visit_Macro(self, node):
+        self.scopes[-1].add(node.name)
+        self._visit_callable(node, ("varargs", "kwargs", "caller"))
+
+    def visit_CallBlock(self, node):
+        self.visit(node.call)
+        self._visit_callable(node, ("varargs", "kwargs"))
+
+    def visit_With(self, node):
+        for value in node.values:
+            self.visit(value)
+        self.scopes.append(set())
+        for target in node.targets:
+            self._bind(target)
+        for child in node.body:
+            self.visit(child)
+        self.scopes.pop()
+
+    def visit_Import(self, node):
+        self.visit(node.template)
+        self.scopes[-1].add(node.target)
+
+    def visit_FromImport(self, node):
+        self.visit(node.template)
+        for name in node.names:
+            self.scopes[-1].add(name[1] if isinstance(name, tuple) else name)
+
+
+def find_template_vars(ast, environment):
+    """
+    Returns a dict of the dotted variable paths used by a parsed template, in
+    the order they first appear, to whether the answers must supply them.
+    Globals of the environment such as range are ignored.
+    """
+    collector = VariableCollector(ignore=environment.globals)
+    collector.visit(ast)
+    return collector.found
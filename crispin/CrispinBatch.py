@@ -0,0 +1,289 @@
+import json
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from crispin.CrispinAPI import RenderedKickstart, _load_answers, render_cache
+from crispin.CrispinCatalog import AnswersCatalog, answers_catalog
+from crispin.CrispinGenerate import compile_recipe, render_kickstart, write_file
+from crispin._util import logger
+
+
+def _render_answers(recipe_file, template_dir, ks_logging, answers, output_dir, name):
+    # Runs in a worker process. Recipes compiled by the parent are inherited
+    # when the pool forks, otherwise each worker compiles a recipe once.
+    compiled = compile_recipe(recipe_file, template_dir, ks_logging)
+    kickstart = render_kickstart(compiled, answers)
+    return str(write_file(kickstart, output_dir, name + ".ks"))
+
+
+def generate_batch(answers_dir, output_dir, jobs=None, ks_logging: bool = False, template_dir=None):
+    """
+    Renders a kickstart for every answers file in answers_dir into output_dir.
+
+    Every distinct recipe is compiled once up front and the kickstarts are
+    rendered and written across a pool of jobs processes. A failing answers
+    file does not stop the others. Returns a dict of answers file to the
+    written kickstart and a dict of answers file to the exception it failed
+    with.
+    """
+    answers_dir = Path(answers_dir)
+    cookbook_dir = answers_dir.parent
+    if template_dir is None:
+        template_dir = cookbook_dir / "templates"
+    template_dir = Path(template_dir)
+
+    written = {}
+    failures = {}
+    work = []
+    compiled = {}
+    catalog = AnswersCatalog(answers_dir)
+    catalog.refresh()
+    for record in catalog.records():
+        answer_file = answers_dir / (record.name + ".json")
+        try:
+            if record.error is not None:
+                raise ValueError(f"Answer file is not valid JSON: {record.error}")
+            answers = record.answers
+            recipe_name = record.recipe
+            if not recipe_name:
+                raise ValueError("Recipe not specified in answers file")
+            recipe_file = cookbook_dir / "recipes" / (recipe_name + ".json")
+            if recipe_file not in compiled:
+                try:
+                    compile_recipe(recipe_file, template_dir, ks_logging)
+                    compiled[recipe_file] = None
+                except Exception as e:
+                    compiled[recipe_file] = e
+            if compiled[recipe_file] is not None:
+                raise compiled[recipe_file]
+            work.append((answer_file, recipe_file, answers))
+        except Exception as e:
+            logger.error(f"!!! {answer_file}: {e}")
+            failures[answer_file] = e
+
+    logger.info(f"Rendering {len(work)} kickstarts from {len(compiled)} recipes.")
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {
+            pool.submit(
+                _render_answers, recipe_file, template_dir, ks_logging, answers, output_dir, answer_file.stem
+            ): answer_file
+            for answer_file, recipe_file, answers in work
+        }
+        for future in as_completed(futures):
+            answer_file = futures[future]
+            try:
+                written[answer_file] = future.result()
+                logger.info(f"Wrote the kickstart for {answer_file} to {written[answer_file]}.")
+            except Exception as e:
+                logger.error(f"!!! {answer_file}: {e}")
+                failures[answer_file] = e
+
+    return written, failures
+
+
+def _prerender_answers(recipe_file, template_dir, answers):
+    # Runs in a worker process started fresh, so each worker compiles a
+    # recipe once, from the compiled store when it is fresh.
+    compiled = compile_recipe(recipe_file, template_dir)
+    return render_kickstart(compiled, answers)
+
+
+def prerender_kickstarts(cookbook_dir, jobs=None):
+    """
+    Renders the kickstart of every answers file in a cookbook across a pool
+    of jobs processes and adds them to render_cache, so the first requests
+    for them are answered from memory. Returns a list of the answers files
+    rendered and a dict of answers file to the exception it failed with.
+    """
+    cookbook_dir = Path(cookbook_dir)
+    template_dir = cookbook_dir / "templates"
+    rendered = []
+    failures = {}
+    work = []
+    catalog = answers_catalog(cookbook_dir)
+    catalog.refresh()
+    for record in catalog.records():
+        answer_file = cookbook_dir / "answers" / (record.name + ".json")
+        try:
+            # Compiles the recipe here too, so template errors are caught
+            # once per recipe and fingerprints are taken before rendering.
+            _, answers, compiled, fingerprint = _load_answers(record.name, cookbook_dir)
+            compiled.schema.validate(answers)
+            recipe_file = cookbook_dir / "recipes" / (record.recipe + ".json")
+            work.append((answer_file, recipe_file, answers, fingerprint))
+        except Exception as e:
+            logger.error(f"!!! Can not render {answer_file}: {e}")
+            failures[answer_file] = e
+
+    logger.info(f"Pre-rendering {len(work)} kickstarts.")
+    # The server is already running threads by now, so workers are spawned
+    # rather than forked from it.
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=context) as pool:
+        futures = {
+            pool.submit(_prerender_answers, recipe_file, template_dir, answers): (answer_file, fingerprint)
+            for answer_file, recipe_file, answers, fingerprint in work
+        }
+        for future in as_completed(futures):
+            answer_file, fingerprint = futures[future]
+            try:
+                kickstart = RenderedKickstart(future.result(), fingerprint, str(answer_file))
+                render_cache.put(kickstart.cache_key, kickstart)
+                rendered.append(answer_file)
+            except Exception as e:
+                logger.error(f"!!! Can not render {answer_file}: {e}")
+                failures[answer_file] = e
+
+    return rendered, failures
+
+
+# Most items of a batch request handed to a worker at once.
+BATCH_CHUNK_SIZE = 32
+
+_batch_pool = None
+_batch_pool_lock = threading.Lock()
+
+
+def batch_pool(jobs=None):
+    """
+    Returns the process pool shared by every batch request, starting it on
+    first use. Its workers live as long as the server, so each compiles a
+    recipe once and renders every later batch from its recipe cache.
+    """
+    global _batch_pool
+    with _batch_pool_lock:
+        if _batch_pool is None:
+            _batch_pool = ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context("spawn"))
+        return _batch_pool
+
+
+def _reset_batch_pool(pool):
+    # A worker that died takes the whole pool down with it.
+    global _batch_pool
+    with _batch_pool_lock:
+        if _batch_pool is pool:
+            _batch_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _render_batch_chunk(template_dir, chunk):
+    # Runs in a batch_pool worker. Returns (index, status, kickstart or
+    # error) for every (index, recipe_file, answers) in chunk.
+    rendered = []
+    for index, recipe_file, answers in chunk:
+        try:
+            rendered.append((index, 200, _prerender_answers(recipe_file, template_dir, answers)))
+        except ValueError as e:
+            rendered.append((index, 400, str(e)))
+        except Exception as e:
+            rendered.append((index, 500, str(e)))
+    return rendered
+
+
+def _is_plain_name(name):
+    # A recipe name is a file name in the recipes dir, never a path out of it.
+    return bool(name) and ".." not in name and not any(c in name for c in "/\\\0")
+
+
+def _batch_line(result):
+    return bytes(json.dumps(result) + "\n", "utf-8")
+
+
+def render_batch(items, cookbook_dir, jobs=None):
+    """
+    Renders a kickstart for each {"recipe": ..., "answers": {...}} item on
+    batch_pool and returns a generator of NDJSON lines, one per item in the
+    order they finish. Each line has the item's index, its "id" if it had
+    one, and either the "kickstart" or an "error" with the HTTP "status" it
+    would have had on its own. Raises ValueError if items is not a list.
+    """
+    if not isinstance(items, list):
+        raise ValueError("Request body must be a JSON array of {recipe, answers} items")
+    cookbook_dir = Path(cookbook_dir)
+    template_dir = cookbook_dir / "templates"
+
+    def result(index, item, **fields):
+        line = {"index": index}
+        if isinstance(item, dict) and "id" in item:
+            line["id"] = item["id"]
+        line.update(fields)
+        return line
+
+    def lines():
+        failed = []
+        work = []
+        checked = {}
+        for index, item in enumerate(items):
+            try:
+                if not isinstance(item, dict) or not isinstance(item.get("recipe"), str) or not isinstance(item.get("answers"), dict):
+                    raise ValueError("Item must be an object with a recipe name and an answers object")
+                if not _is_plain_name(item["recipe"]):
+                    raise ValueError(f"Invalid recipe name {item['recipe']!r}")
+                recipe_file = cookbook_dir / "recipes" / (item["recipe"] + ".json")
+                if recipe_file not in checked:
+                    # Compiling here reports a broken recipe once rather
+                    # than from every worker.
+                    try:
+                        if not recipe_file.exists():
+                            raise FileNotFoundError(f"Recipe file not found at {recipe_file}")
+                        compile_recipe(recipe_file, template_dir)
+                        checked[recipe_file] = None
+                    except Exception as e:
+                        checked[recipe_file] = e
+                if checked[recipe_file] is not None:
+                    raise checked[recipe_file]
+                work.append((index, item, recipe_file))
+            except FileNotFoundError as e:
+                failed.append(result(index, item, status=404, error=str(e)))
+            except ValueError as e:
+                failed.append(result(index, item, status=400, error=str(e)))
+            except Exception as e:
+                failed.append(result(index, item, status=500, error=str(e)))
+        for line in failed:
+            yield _batch_line(line)
+        if not work:
+            return
+
+        logger.info(f"Rendering a batch of {len(work)} kickstarts from {len(checked)} recipes.")
+        pool = batch_pool(jobs)
+        # Items go to the workers a few at a time, enough to keep the cost of
+        # passing them between processes down while still giving every
+        # worker several chunks of even a small batch.
+        size = max(1, min(BATCH_CHUNK_SIZE, len(work) // ((jobs or os.cpu_count() or 1) * 4)))
+        futures = {}
+        try:
+            try:
+                for start in range(0, len(work), size):
+                    chunk = work[start:start + size]
+                    future = pool.submit(
+                        _render_batch_chunk, template_dir, [(index, recipe_file, item["answers"]) for index, item, recipe_file in chunk]
+                    )
+                    futures[future] = chunk
+            except BrokenProcessPool:
+                _reset_batch_pool(pool)
+                raise
+            for future in as_completed(futures):
+                chunk = futures.pop(future)
+                items_by_index = {index: item for index, item, _ in chunk}
+                try:
+                    rendered = future.result()
+                except BrokenProcessPool as e:
+                    _reset_batch_pool(pool)
+                    rendered = [(index, 500, f"Worker process died: {e}") for index in items_by_index]
+                except Exception as e:
+                    rendered = [(index, 500, str(e)) for index in items_by_index]
+                for index, status, text in rendered:
+                    item = items_by_index[index]
+                    if status == 200:
+                        yield _batch_line(result(index, item, status=status, kickstart=text))
+                    else:
+                        yield _batch_line(result(index, item, status=status, error=text))
+        finally:
+            # The client went away, the rest of the batch is not wanted.
+            for future in futures:
+                future.cancel()
+
+    return lines()
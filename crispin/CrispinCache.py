@@ -0,0 +1,194 @@
+import os
+import threading
+import weakref
+from collections import OrderedDict
+from crispin.CrispinMetrics import register_collector
+from crispin._util import logger
+
+_caches = weakref.WeakSet()
+
+
+def file_fingerprint(paths):
+    """
+    Returns a tuple of (path, mtime_ns, size) for every path given.
+    A missing file is recorded with a mtime and size of None so that its
+    creation also changes the fingerprint.
+    """
+    fingerprint = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            fingerprint.append((os.path.abspath(path), st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            fingerprint.append((os.path.abspath(path), None, None))
+    return tuple(fingerprint)
+
+
+def depends_on(fingerprint, paths):
+    """
+    Checks whether any of paths is part of a fingerprint.
+    """
+    return any(path in paths for path, _, _ in fingerprint)
+
+
+def is_fresh(fingerprint):
+    """
+    Re-stats every file in a fingerprint and checks nothing has changed.
+    """
+    return file_fingerprint(path for path, _, _ in fingerprint) == fingerprint
+
+
+class LRUCache:
+    """
+    A small thread safe LRU cache.
+
+    Entries are evicted least recently used first once there are more than
+    maxsize of them or, when maxbytes is set, once the entries weigh more
+    than maxbytes in total as measured by weigh. An entry is weighed when
+    it is put, reweigh updates the weight of one that has grown since.
+    """
+
+    def __init__(self, name: str, maxsize: int = 128, maxbytes: int = None, weigh=len):
+        self.name = name
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.weigh = weigh
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._weights = {}
+        self._lock = threading.Lock()
+        _caches.add(self)
+
+    def _weight(self, value):
+        return self.weigh(value) if self.maxbytes is not None else 0
+
+    def get(self, key, default=None, valid=None):
+        """
+        Returns the entry for key. When valid is given and valid(entry) is
+        false the entry is dropped and counted as a miss.
+        """
+        with self._lock:
+            try:
+                self._entries.move_to_end(key)
+                value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+        if valid is not None and not valid(value):
+            with self._lock:
+                if self._entries.get(key) is value:
+                    del self._entries[key]
+                    self.bytes -= self._weights.pop(key)
+                self.misses += 1
+                self.invalidations += 1
+            return default
+        with self._lock:
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        weight = self._weight(value)
+        with self._lock:
+            if key in self._entries:
+                del self._entries[key]
+                self.bytes -= self._weights.pop(key)
+            if self.maxbytes is not None and weight > self.maxbytes:
+                logger.debug(f"{self.name} cache not storing {key}, {weight} bytes is over the limit.")
+                return
+            self._entries[key] = value
+            self._weights[key] = weight
+            self.bytes += weight
+            self._shrink()
+
+    def reweigh(self, key, value):
+        """
+        Weighs the entry for key again if it still is value, evicting others
+        or the entry itself to stay within maxbytes.
+        """
+        if self.maxbytes is None:
+            return
+        weight = self.weigh(value)
+        with self._lock:
+            if self._entries.get(key) is not value:
+                return
+            self.bytes += weight - self._weights[key]
+            self._weights[key] = weight
+            if weight > self.maxbytes:
+                del self._entries[key]
+                self.bytes -= self._weights.pop(key)
+                self.evictions += 1
+                logger.debug(f"{self.name} cache evicted {key}, {weight} bytes is over the limit.")
+                return
+            # Counts as just used, and so is not evicted to make room for itself.
+            self._entries.move_to_end(key)
+            self._shrink()
+
+    def _shrink(self):
+        while len(self._entries) > self.maxsize or (
+            self.maxbytes is not None and self.bytes > self.maxbytes
+        ):
+            evicted, _ = self._entries.popitem(last=False)
+            self.bytes -= self._weights.pop(evicted)
+            self.evictions += 1
+            logger.debug(f"{self.name} cache evicted {evicted}.")
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            value = self._entries.pop(key)
+            self.bytes -= self._weights.pop(key)
+            return value
+
+    def invalidate(self, predicate):
+        """
+        Drops every entry for which predicate(key, value) is true.
+        """
+        with self._lock:
+            stale = [key for key, value in self._entries.items() if predicate(key, value)]
+            for key in stale:
+                del self._entries[key]
+                self.bytes -= self._weights.pop(key)
+            self.invalidations += len(stale)
+        for key in stale:
+            logger.debug(f"{self.name} cache invalidated {key}.")
+        return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._weights.clear()
+            self.bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+
+def _cache_metrics():
+    families = (
+        ("crispin_cache_hits_total", "counter", "Cache lookups that found a usable entry.", "hits"),
+        ("crispin_cache_misses_total", "counter", "Cache lookups that found no entry or a stale one.", "misses"),
+        ("crispin_cache_evictions_total", "counter", "Entries evicted to stay within the cache's limits.", "evictions"),
+        ("crispin_cache_invalidations_total", "counter", "Entries dropped because a file they were built from changed.", "invalidations"),
+        ("crispin_cache_entries", "gauge", "Entries currently cached.", None),
+        ("crispin_cache_bytes", "gauge", "Bytes currently cached, for caches bounded by size.", "bytes"),
+    )
+    caches = sorted(_caches, key=lambda cache: cache.name)
+    lines = []
+    for name, kind, help, attribute in families:
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+        for cache in caches:
+            value = len(cache) if attribute is None else getattr(cache, attribute)
+            lines.append(f'{name}{{cache="{cache.name}"}} {value}')
+    return lines
+
+
+register_collector(_cache_metrics)
@@ -0,0 +1,138 @@
+import json
+import os
+import threading
+from crispin._util import logger
+
+
+class AnswerRecord:
+    """
+    An answers file as parsed into the catalog. The answers are shared by
+    every request for them and must not be modified.
+    """
+
+    __slots__ = ("name", "path", "identity", "fingerprint", "answers", "recipe", "source", "error")
+
+    def __init__(self, name, path, st, answers=None, error=None):
+        self.name = name
+        self.path = path
+        self.identity = (st.st_mtime_ns, st.st_size)
+        self.fingerprint = ((os.path.abspath(path), st.st_mtime_ns, st.st_size),)
+        self.answers = answers
+        self.error = error
+        metadata = answers.get("metadata") if isinstance(answers, dict) else None
+        if not isinstance(metadata, dict):
+            metadata = {}
+        self.recipe = metadata.get("recipe")
+        self.source = metadata.get("source")
+
+
+class AnswersCatalog:
+    """
+    An index of the answers files in a directory by answer name.
+
+    Every file is parsed once and only parsed again when its mtime or size
+    changes, so looking an answer up costs a stat rather than a JSON parse
+    and refreshing the whole catalog only parses the files that changed.
+    """
+
+    def __init__(self, answers_dir):
+        self.answers_dir = os.path.abspath(answers_dir)
+        self._records = {}
+        self._lock = threading.Lock()
+
+    def _path(self, name):
+        return os.path.join(self.answers_dir, name + ".json")
+
+    def _load(self, name, path):
+        with open(path, "r") as f:
+            st = os.fstat(f.fileno())
+            try:
+                record = AnswerRecord(name, path, st, answers=json.load(f))
+            except json.JSONDecodeError as e:
+                logger.error(f"Check {path}. An error ocurred parsing it: {e}")
+                record = AnswerRecord(name, path, st, error=e)
+        with self._lock:
+            self._records[name] = record
+        return record
+
+    def refresh(self):
+        """
+        Brings the catalog in line with the answers directory. Returns the
+        names of the answers that were added, changed or removed.
+        """
+        changed = set()
+        seen = set()
+        try:
+            entries = list(os.scandir(self.answers_dir))
+        except FileNotFoundError:
+            entries = []
+        for entry in entries:
+            if not entry.name.endswith(".json"):
+                continue
+            name = entry.name[: -len(".json")]
+            try:
+                st = entry.stat()
+                record = self._records.get(name)
+                if record is None or record.identity != (st.st_mtime_ns, st.st_size):
+                    self._load(name, entry.path)
+                    changed.add(name)
+            except FileNotFoundError:
+                continue
+            seen.add(name)
+        with self._lock:
+            for name in self._records.keys() - seen:
+                del self._records[name]
+                changed.add(name)
+        if changed:
+            logger.debug(f"Answers catalog {self.answers_dir} changed: {sorted(changed)}")
+        return changed
+
+    def get(self, name):
+        """
+        Returns the AnswerRecord for an answer name, parsing the file again
+        only if it changed. Raises FileNotFoundError if there is no such
+        answers file and ValueError if it is not valid JSON.
+        """
+        path = self._path(name)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            with self._lock:
+                self._records.pop(name, None)
+            raise FileNotFoundError(f"Answer file not found at {path}")
+        record = self._records.get(name)
+        if record is None or record.identity != (st.st_mtime_ns, st.st_size):
+            record = self._load(name, path)
+        if record.error is not None:
+            raise ValueError(f"Answer file {path} is not valid JSON: {record.error}")
+        return record
+
+    def records(self):
+        """
+        Returns every AnswerRecord, parseable or not, sorted by name.
+        """
+        with self._lock:
+            return [self._records[name] for name in sorted(self._records)]
+
+    def __len__(self):
+        return len(self._records)
+
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+def answers_catalog(cookbook_dir):
+    """
+    Returns the AnswersCatalog of a cookbook's answers directory, shared by
+    everything in the process using that cookbook. It is filled on first
+    use, after that callers refresh it or look answers up one at a time.
+    """
+    answers_dir = os.path.join(os.path.abspath(cookbook_dir), "answers")
+    with _catalogs_lock:
+        catalog = _catalogs.get(answers_dir)
+        if catalog is None:
+            catalog = AnswersCatalog(answers_dir)
+            catalog.refresh()
+            _catalogs[answers_dir] = catalog
+        return catalog
@@ -0,0 +1,121 @@
+import gzip
+import hashlib
+import threading
+from crispin._util import logger
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Bodies smaller than this are not worth the Content-Encoding header.
+MIN_COMPRESS_SIZE = 256
+GZIP_LEVEL = 9
+ZSTD_LEVEL = 19
+
+# Content codings in order of preference, best compression first.
+ENCODINGS = ("zstd", "gzip") if zstandard is not None else ("gzip",)
+# Suffixes of precompressed siblings of static files.
+SUFFIXES = {"zstd": ".zst", "gzip": ".gz"}
+
+_zstd_local = threading.local()
+
+
+def parse_accept_encoding(header):
+    """
+    Returns a dict of content coding to q-value from an Accept-Encoding
+    header. Codings the client did not list are absent.
+    """
+    accepted = {}
+    if not header:
+        return accepted
+    for item in header.split(","):
+        coding, _, params = item.strip().partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+    return accepted
+
+
+def negotiate(header, available=ENCODINGS):
+    """
+    Returns the content coding from available the client prefers, or None
+    to send the body as is. Ties go to the order of available.
+    """
+    accepted = parse_accept_encoding(header)
+    wildcard = accepted.get("*", 0.0)
+    best = None
+    best_q = 0.0
+    for encoding in available:
+        q = accepted.get(encoding, wildcard)
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def compress(body: bytes, encoding: str):
+    match encoding:
+        case "gzip":
+            # A fixed mtime keeps the output, and so its ETag, stable.
+            return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+        case "zstd":
+            compressor = getattr(_zstd_local, "compressor", None)
+            if compressor is None:
+                compressor = _zstd_local.compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+            return compressor.compress(body)
+        case _:
+            raise ValueError(f"Unsupported content coding {encoding}")
+
+
+class EncodedBody:
+    """
+    A response body with its ETag. Compressed variants are made the first
+    time a client asks for them and kept, so a body is compressed once per
+    coding rather than once per request.
+    """
+
+    __slots__ = ("body", "etag", "_variants")
+
+    def __init__(self, body):
+        self.body = body if isinstance(body, bytes) else bytes(body, "utf-8")
+        self.etag = f'"{hashlib.sha1(self.body).hexdigest()}"'
+        self._variants = {}
+
+    @property
+    def text(self):
+        return self.body.decode("utf-8")
+
+    @property
+    def size(self):
+        """
+        Bytes held by the body and every compressed variant made so far.
+        """
+        return len(self.body) + sum(len(body) for body, _, encoding in list(self._variants.values()) if encoding is not None)
+
+    def encoded(self, encoding):
+        """
+        Returns (body, etag, encoding) of the variant to send for a
+        negotiated coding. The plain body is returned when encoding is None
+        or compressing would not make it smaller.
+        """
+        if encoding is None or len(self.body) < MIN_COMPRESS_SIZE:
+            return self.body, self.etag, None
+        variant = self._variants.get(encoding)
+        if variant is None:
+            compressed = compress(self.body, encoding)
+            if len(compressed) < len(self.body):
+                variant = (compressed, f'{self.etag[:-1]}-{encoding}"', encoding)
+            else:
+                variant = (self.body, self.etag, None)
+            logger.debug(f"Compressed {len(self.body)} bytes to {len(variant[0])} with {encoding}.")
+            self._variants[encoding] = variant
+        return variant
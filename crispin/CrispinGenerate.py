@@ -1,34 +1,24 @@
 import json
+import os
+import threading
+import time
 from pathlib import Path
-from jinja2 import Environment, Undefined
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache, TemplateNotFound, TemplateSyntaxError, nodes
 from typing import Dict
-from ._util import logger, dict_to_dot, dot_to_dict
-# https://stackoverflow.com/a/77311286
-def create_collector():
-    collected_variables = set()
-
-    class CollectUndefined(Undefined):
-        def __init__(self, name, parent=None):
-            self.name = name
-            self.parent = parent
-            collected_variables.add(str(self))
-
-        def __str__(self):
-            if self.parent is not None:
-                return f"{self.parent}.{self.name}"
-            return self.name
-
-        def __getattr__(self, name: str):
-            return CollectUndefined(name, parent=self)
-
-    return collected_variables, CollectUndefined
+from ._util import logger, dict_to_dot
+from .CrispinCache import LRUCache, file_fingerprint, is_fresh
+from .CrispinCatalog import AnswersCatalog
+from .CrispinAnalyze import find_template_vars
+from .CrispinSchema import AnswerSchema
+from .CrispinMetrics import timed, stage_seconds
+from .CrispinStore import STORE_DIR, read_record
 
 def find_all_vars(template_content):
-    vars, undefined_cls = create_collector()
-    env = Environment(undefined=undefined_cls)
-    tpl = env.from_string(template_content)
-    tpl.render({})  # empty so all variables are undefined
-    return vars
+    """
+    Returns the dotted path of every variable the template expects in its
+    answers, found by walking the template's syntax tree.
+    """
+    return list(_as_compiled(template_content).variables)
 
 
 def read_template(infile):
@@ -72,16 +62,17 @@ def write_file(file_data: str, output_path: str, file_name: str):
         raise
 
 
-def generate_template(recipe, template_path, ks_logging: bool = False):
+def load_recipe(recipe):
 
     try:
-        with open(recipe, "r") as fh:
+        with timed("recipe_parse"), open(recipe, "r") as fh:
             logger.info(f"Opened recipe {recipe}.")
             template = fh.read().strip()
             recipe_json = json.loads(template)
             logger.debug(
                 f"Recipe loaded as json:\n {json.dumps(recipe_json, indent=2)}"
             )
+            return recipe_json
     except FileNotFoundError as e:
         logger.error(f"!!! Could not read {recipe}: {e}")
         raise
@@ -92,10 +83,15 @@ def generate_template(recipe, template_path, ks_logging: bool = False):
         logger.error(f"!!! UNHANDLED EXCEPTION {e}")
         raise
 
-    logger.info("Concatenating templates into master template.")
-    master_template = ""
+
+def recipe_fragments(recipe_json, template_path):
+    """
+    Returns the (template name, path) of every fragment in a recipe, in order.
+    """
+    template_path = Path(template_path)
     ingredients = recipe_json["recipe"]
     logger.debug(f"Templates found:\n {json.dumps(ingredients, indent=2)}")
+    fragments = []
     for template_directory in ingredients:
         logger.info(
             f"Starting {template_directory} scan in {template_path / template_directory}."
@@ -103,42 +99,382 @@ def generate_template(recipe, template_path, ks_logging: bool = False):
         for template in ingredients[template_directory]:
             path = template_path / template_directory / template
             logger.debug(f"Searching for {template} at {path}")
-            current_template = read_template(path)
-            if(ks_logging):
-                split_template = current_template.splitlines()
-                for line in split_template:
-                    if(line.startswith("%pre") or line.startswith("%post")):
-                        line += f" --log=/tmp/crispin-{template}"
-                    master_template += line+"\n"
-                master_template += "\n"
-            else:
-                master_template += current_template
-                master_template += "\n"
+            fragments.append((template, path))
+    return fragments
+
+
+def inject_logging(template_name: str, template: str):
+    """
+    Fragment stage that makes every %pre and %post section log to
+    /tmp/crispin-<template_name> on the kickstarted machine.
+    """
+    lines = []
+    for line in template.splitlines():
+        if(line.startswith("%pre") or line.startswith("%post")):
+            line += f" --log=/tmp/crispin-{template_name}"
+        lines.append(line)
+        lines.append("\n")
+    return "".join(lines)
+
+
+def fragment_stages(ks_logging: bool = False):
+    """
+    Returns the stages every fragment is passed through, in order. A stage
+    takes the template name and text and returns the new text.
+    """
+    stages = []
+    if ks_logging:
+        stages.append(inject_logging)
+    return tuple(stages)
+
+
+# Fragments after being run through their stages, keyed by path and stages
+# and checked against the file's mtime and size before reuse.
+fragment_cache = LRUCache("fragment", maxsize=4096)
+
+
+def transform_fragment(template_name: str, path, stages=()):
+    """
+    Reads a fragment and runs it through stages, reusing the previous result
+    if the file is unchanged.
+    """
+    key = (os.path.abspath(path), stages)
+    st = os.stat(path)
+    identity = (st.st_mtime_ns, st.st_size)
+    cached = fragment_cache.get(key, valid=lambda cached: cached[0] == identity)
+    if cached is not None:
+        return cached[1]
+
+    template = read_template(path)
+    for stage in stages:
+        template = stage(template_name, template)
+    fragment_cache.put(key, (identity, template))
+    return template
+
+
+def assemble_template(fragments, ks_logging: bool = False):
+
+    logger.info("Concatenating templates into master template.")
+    stages = fragment_stages(ks_logging)
+    parts = []
+    with timed("fragment_assembly"):
+        for template, path in fragments:
+            try:
+                parts.append(transform_fragment(template, path, stages))
+            except FileNotFoundError:
+                logger.error(f"!!! File not found {path}")
+                raise
+            parts.append("\n")
+
+        return "".join(parts)
+
+
+def generate_template(recipe, template_path, ks_logging: bool = False):
+    recipe_json = load_recipe(recipe)
+    return assemble_template(recipe_fragments(recipe_json, template_path), ks_logging)
+
+
+class CompiledRecipe:
+    """
+    A recipe assembled into its master template and compiled by Jinja2.
+
+    The fingerprint holds the (path, mtime, size) of the recipe and every
+    fragment it was built from so that the entry can be checked for
+    staleness without re-reading any of them.
+
+    Passing the variables and Jinja2 code object of an earlier compile, as
+    kept in the cookbook's compiled store, skips parsing altogether. A
+    recipe composed of includes is compiled in, and renders through, the
+    shared fragment environment it is given.
+    """
+
+    def __init__(self, source: str, fingerprint, variables=None, code=None, environment=None):
+        self.source = source
+        self.fingerprint = fingerprint
+        self.composed = environment is not None
+        env = environment if environment is not None else Environment()
+        if code is not None:
+            with timed("store_load"):
+                self.template = env.template_class.from_code(env, code, env.make_globals(None))
+        else:
+            # Parse once, the same tree gives both the variables and the template.
+            start = time.perf_counter()
+            ast = env.parse(source)
+            parsed = time.perf_counter()
+            if variables is None:
+                variables = find_template_vars(ast, env)
+            discovered = time.perf_counter()
+            code = env.compile(ast)
+            self.template = env.template_class.from_code(env, code, env.make_globals(None))
+            stage_seconds.observe(parsed - start + time.perf_counter() - discovered, "compile")
+            stage_seconds.observe(discovered - parsed, "variable_discovery")
+        self.code = code
+        # Every path the recipe uses, to whether the answers must supply it
+        self.variables = dict(variables)
+        self.schema = AnswerSchema(self.variables)
+
+
+class FragmentLoader(FileSystemLoader):
+    """
+    Loads fragments from a template dir by their "<directory>/<template>"
+    name, run through the fragment stages.
+    """
+
+    def __init__(self, searchpath, stages=()):
+        super().__init__(searchpath)
+        self.stages = stages
+
+    def get_source(self, environment, template):
+        source, filename, uptodate = super().get_source(environment, template)
+        # Stages see the template name as written in the recipe.
+        template_name = template.split("/", 1)[-1]
+        for stage in self.stages:
+            source = stage(template_name, source)
+        return source, filename, uptodate
+
+
+# Compiled fragments kept by each fragment environment. Sized for every
+# fragment of a large cookbook so shared fragments are never recompiled.
+FRAGMENT_ENV_CACHE_SIZE = 4096
 
-    return master_template
+_fragment_envs = {}
+_fragment_envs_lock = threading.Lock()
+
+
+def fragment_environment(template_path, stages=()):
+    """
+    Returns the Environment shared by every recipe using template_path and
+    stages. Fragments are compiled once, reloaded when their file changes
+    and, once the cookbook has a compiled store, kept as bytecode on disk.
+    """
+    key = (os.path.abspath(template_path), stages)
+    with _fragment_envs_lock:
+        env = _fragment_envs.get(key)
+        if env is None:
+            store = Path(template_path).parent / STORE_DIR
+            bytecode_cache = None
+            if store.is_dir() and os.access(store, os.W_OK):
+                # Jinja2 keys bytecode by file name alone, so every set of
+                # stages needs a directory of its own.
+                bytecode_dir = store / "bytecode" / ("-".join(stage.__name__ for stage in stages) or "plain")
+                try:
+                    bytecode_dir.mkdir(parents=True, exist_ok=True)
+                    bytecode_cache = FileSystemBytecodeCache(str(bytecode_dir))
+                except OSError as e:
+                    logger.warning(f"Not keeping fragment bytecode in {bytecode_dir}: {e}")
+            env = _fragment_envs[key] = Environment(
+                loader=FragmentLoader(template_path, stages),
+                bytecode_cache=bytecode_cache,
+                cache_size=FRAGMENT_ENV_CACHE_SIZE,
+                auto_reload=True,
+                # The separator between fragments is added by the recipe.
+                keep_trailing_newline=True,
+            )
+        return env
+
+
+def _defined_names(ast):
+    # Names a fragment could leak to the fragments after it when pasted
+    # into one template.
+    names = set()
+    for node in ast.find_all((nodes.Assign, nodes.AssignBlock, nodes.Macro, nodes.Import, nodes.FromImport)):
+        if isinstance(node, (nodes.Assign, nodes.AssignBlock)):
+            targets = [node.target, *node.target.find_all(nodes.Name)]
+            names.update(target.name for target in targets if isinstance(target, nodes.Name))
+        elif isinstance(node, nodes.Macro):
+            names.add(node.name)
+        elif isinstance(node, nodes.Import):
+            names.add(node.target)
+        else:
+            names.update(name[1] if isinstance(name, tuple) else name for name in node.names)
+    return frozenset(names)
+
+
+_EDGE_STRIP_START = ("{%-", "{{-", "{#-")
+_EDGE_STRIP_END = ("-%}", "-}}", "-#}")
+
+# Per fragment analysis, keyed and checked like fragment_cache.
+fragment_analysis_cache = LRUCache("fragment_analysis", maxsize=4096)
+
+
+def analyze_fragment(template_name: str, path, stages=()):
+    """
+    Returns (variables, defined names) for a fragment on its own, or None if
+    it only makes sense pasted next to its neighbours: it does not parse
+    alone, uses template inheritance or strips whitespace across its edges.
+    """
+    key = (os.path.abspath(path), stages)
+    st = os.stat(path)
+    identity = (st.st_mtime_ns, st.st_size)
+    cached = fragment_analysis_cache.get(key, valid=lambda cached: cached[0] == identity)
+    if cached is not None:
+        return cached[1]
+
+    source = transform_fragment(template_name, path, stages)
+    analysis = None
+    if not source.lstrip().startswith(_EDGE_STRIP_START) and not source.rstrip().endswith(_EDGE_STRIP_END):
+        env = Environment()
+        try:
+            with timed("variable_discovery"):
+                ast = env.parse(source)
+                if not any(ast.find_all((nodes.Extends, nodes.Block))):
+                    analysis = (find_template_vars(ast, env), _defined_names(ast))
+        except TemplateSyntaxError:
+            pass
+    fragment_analysis_cache.put(key, (identity, analysis))
+    return analysis
+
+
+def compose_recipe(fragments, template_path, fingerprint, ks_logging: bool = False):
+    """
+    Compiles a recipe as a template including each of its fragments from
+    the shared fragment environment, rendering exactly as the fragments
+    pasted together would. Returns None if a fragment can not be composed
+    that way and the recipe has to be compiled as one template.
+    """
+    stages = fragment_stages(ks_logging)
+    variables = {}
+    defined = set()
+    names = []
+    for template, path in fragments:
+        analysis = analyze_fragment(template, path, stages)
+        if analysis is None:
+            logger.debug(f"Fragment {path} can not be included, compiling the recipe as one template.")
+            return None
+        fragment_vars, fragment_defined = analysis
+        if defined.intersection(var.split(".", 1)[0] for var in fragment_vars):
+            logger.debug(f"Fragment {path} uses names set by an earlier fragment, compiling the recipe as one template.")
+            return None
+        defined.update(fragment_defined)
+        for var, required in fragment_vars.items():
+            variables[var] = variables.get(var, False) or required
+        names.append(Path(path).relative_to(template_path).as_posix())
+
+    env = fragment_environment(template_path, stages)
+    with timed("compile"):
+        for name in names:
+            try:
+                env.get_template(name)
+            except TemplateNotFound:
+                return None
+    source = "\n".join("{% include " + json.dumps(name) + " %}" for name in names)
+    return CompiledRecipe(source, fingerprint, variables, environment=env)
+
+
+# Process wide cache of compiled recipes so that a recipe is only compiled
+# once no matter how many kickstarts are rendered from it.
+recipe_cache = LRUCache("recipe", maxsize=64)
+
+
+def build_compiled_recipe(recipe, template_path, ks_logging: bool = False):
+    """
+    Compiles a recipe from source, bypassing the recipe cache and store.
+    Fragments are included from the shared fragment environment where
+    possible and pasted into one template otherwise.
+    """
+    recipe_fingerprint = file_fingerprint([recipe])
+    fragments = recipe_fragments(load_recipe(recipe), template_path)
+    fingerprint = recipe_fingerprint + file_fingerprint(path for _, path in fragments)
+    compiled = compose_recipe(fragments, template_path, fingerprint, ks_logging)
+    if compiled is None:
+        compiled = CompiledRecipe(assemble_template(fragments, ks_logging), fingerprint)
+    return compiled
+
+
+def compile_recipe(recipe, template_path, ks_logging: bool = False):
+    """
+    Returns the CompiledRecipe for a recipe, reusing the cached one if neither
+    the recipe nor any of its fragments have changed since it was compiled.
+
+    On a cache miss the cookbook's compiled store, filled by `crispin
+    compile`, is tried before compiling from source.
+    """
+    key = (str(recipe), str(template_path), ks_logging)
+    compiled = recipe_cache.get(key, valid=lambda compiled: is_fresh(compiled.fingerprint))
+    if compiled is not None:
+        logger.debug(f"Using cached compiled recipe {recipe}.")
+        return compiled
+
+    record = read_record(recipe, template_path, ks_logging)
+    if record is not None:
+        logger.debug(f"Using stored compiled recipe {recipe}.")
+        env = fragment_environment(template_path, fragment_stages(ks_logging)) if record["composed"] else None
+        compiled = CompiledRecipe(record["source"], record["fingerprint"], record["variables"], record["code"], env)
+    else:
+        compiled = build_compiled_recipe(recipe, template_path, ks_logging)
+    recipe_cache.put(key, compiled)
+    return compiled
+
+
+def _as_compiled(generated_template):
+    if isinstance(generated_template, CompiledRecipe):
+        return generated_template
+    return CompiledRecipe(generated_template, ())
 
 
 def check_answers(generated:Dict[str,str], supplied:Dict[str,str]):
-    
-    missing = []
-    supplied = dict_to_dot(supplied)
-    for g_ans in dict_to_dot(generated):
-        if(g_ans not in supplied):
-            missing.append(g_ans)
-    if len(missing) > 0:
-        raise ValueError(f"Answers file is missing values for: {missing}.")
-
-def generate_kickstart(generated_template: str, answers_file: str):
-    env = Environment()
-
-    ks_template = env.from_string(generated_template)
-
-    generated_answers = json.loads(generate_empty_answers(generated_template))
-    with open(answers_file, "r") as fh:
-        user_answers = json.loads(fh.read())
+    AnswerSchema(dict_to_dot(generated)).validate(supplied)
+
+def render_kickstart(compiled: CompiledRecipe, answers: dict):
+    """
+    Checks the answers against the recipe's schema and renders the kickstart.
+    """
+    with timed("validation"):
+        compiled.schema.validate(answers)
+    with timed("render"):
+        return compiled.template.render(answers)
+
+
+def stream_kickstart(compiled: CompiledRecipe, answers: dict, chunk_size: int = 16 * 1024):
+    """
+    Checks the answers against the recipe's schema and returns a generator
+    of the rendered kickstart as utf-8 chunks of roughly chunk_size bytes.
+
+    The answers are checked before anything is rendered so a ValueError is
+    raised here rather than part way through the stream.
+    """
+    with timed("validation"):
+        compiled.schema.validate(answers)
+    return _coalesce(compiled.template.generate(answers), chunk_size)
+
+
+def _coalesce(pieces, chunk_size):
+    # Jinja2 yields every text and expression node separately, batch them
+    # up so the socket sees a few large writes instead of many tiny ones.
+    # Only the time spent rendering counts towards the render stage, not the
+    # time the consumer spends writing chunks out.
+    buffer = []
+    buffered = 0
+    rendering = 0.0
+    start = time.perf_counter()
+    for piece in pieces:
+        buffer.append(piece)
+        buffered += len(piece)
+        if buffered >= chunk_size:
+            chunk = "".join(buffer).encode("utf-8")
+            rendering += time.perf_counter() - start
+            yield chunk
+            start = time.perf_counter()
+            buffer = []
+            buffered = 0
+    chunk = "".join(buffer).encode("utf-8")
+    stage_seconds.observe(rendering + time.perf_counter() - start, "render")
+    if chunk:
+        yield chunk
+
+
+def generate_kickstart(generated_template, answers_file: str):
+    compiled = _as_compiled(generated_template)
+
+    answers_file = Path(answers_file)
+    if answers_file.suffix == ".json":
+        # Parsed the same way as the answers the server and --batch read
+        user_answers = AnswersCatalog(answers_file.parent).get(answers_file.stem).answers
+    else:
+        with open(answers_file, "r") as fh:
+            user_answers = json.loads(fh.read())
     try:
-        check_answers(generated_answers, user_answers)
-        ks_render = ks_template.render(user_answers)
+        ks_render = render_kickstart(compiled, user_answers)
         return ks_render
     except Exception as e:
         logger.error(f"!!! Unable to render file !!!")
@@ -146,15 +482,11 @@ def generate_kickstart(generated_template: str, answers_file: str):
         raise
 
 
-def generate_kickstart_from_answers_dict(generated_template: str, answers: dict):
-    env = Environment()
-
-    ks_template = env.from_string(generated_template)
+def generate_kickstart_from_answers_dict(generated_template, answers: dict):
+    compiled = _as_compiled(generated_template)
 
-    generated_answers = json.loads(generate_empty_answers(generated_template))
     try:
-        check_answers(generated_answers, answers)
-        ks_render = ks_template.render(answers)
+        ks_render = render_kickstart(compiled, answers)
         return ks_render, None
     except ValueError as e:
         logger.error(f"!!! Answer check failed: {e}")
@@ -164,8 +496,7 @@ def generate_kickstart_from_answers_dict(generated_template: str, answers: dict)
         logger.error(f"{e=}")
         return None, e
 
-def generate_empty_answers(generated_template: str):
-    set_vars = find_all_vars(generated_template)
-    ret_dict = dot_to_dict(list(set_vars))
+def generate_empty_answers(generated_template):
+    ret_dict = _as_compiled(generated_template).schema.skeleton()
 
     return json.dumps(ret_dict, indent=2)
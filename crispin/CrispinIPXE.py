@@ -1,6 +1,7 @@
-import json
 from pathlib import Path
 from urllib.parse import urljoin
+from crispin.CrispinCatalog import answers_catalog
+from crispin.CrispinMirror import mirror_url
 from crispin._util import logger
 
 class MenuEntry:
@@ -43,7 +44,77 @@ class IPXEMenu:
         
         return menu
 
-def generate_menu(cookbook_dir, hostname):
+def menu_entry(answer_name, source, hostname, mirror=False):
+    """
+    Creates the MenuEntry for a single answers file from the source in its
+    metadata, or None if it has no usable source. With mirror the boot
+    artifacts of http sources are fetched through crispin's mirror cache.
+    """
+    answer_file = f"{answer_name}.json"
+    logger.debug(f"Found answer {answer_name} with source {source}. Creating menu entry...")
+
+    if source:
+        match source:
+            case uri if source.startswith("http") and source.endswith("/"):
+                logger.debug(f"Found a URI for {answer_file} that appears to be an http repo: {uri}")
+                kernel_url = urljoin(source, "images/pxeboot/vmlinuz")
+                initrd_url = urljoin(source, "images/pxeboot/initrd.img")
+                stage2_url = urljoin(source, "images/install.img")
+
+                stage2 = ""
+                if mirror:
+                    kernel_url = mirror_url(hostname, source, "images/pxeboot/vmlinuz")
+                    initrd_url = mirror_url(hostname, source, "images/pxeboot/initrd.img")
+                    stage2 = f" inst.stage2={mirror_url(hostname, source)}"
+
+                bootcmd = f"kernel {kernel_url} inst.ks=http://{hostname}:9000/crispin/get/{answer_name} inst.repo={source}{stage2} ip=dhcp quiet\n"
+                bootcmd += f"initrd {initrd_url}\n"
+                bootcmd += "boot"
+
+                return MenuEntry(answer_name, bootcmd)
+
+            case uri if source.endswith(".iso"):
+                logger.debug(f"Found URI for {answer_file} that is an ISO file: {uri}.")
+
+            case uri if source.endswith("/") and Path(source).exists():
+                logger.debug(f"Found URI for {answer_file} that appears to be a crispin hosted file: {uri}.")
+                kernel_url = f"http://{hostname}:9000/{source}/vmlinuz"
+                initrd_url = f"http://{hostname}:9000/{source}/initrd.img"
+                stage2_url = f"http://{hostname}:9000/{source}/install.img"
+
+                bootcmd = f"kernel {kernel_url} inst.ks=http://{hostname}:9000/crispin/get/{answer_name} inst.repo={source} inst.stage2={stage2_url} ip=dhcp quiet\n"
+                bootcmd += f"initrd {initrd_url}\n"
+                bootcmd += "boot"
+
+                return MenuEntry(answer_name, bootcmd)
+
+            case _:
+                logger.warning(f"Source in metadata could not be parsed! Skipping {answer_file}!")
+    return None
+
+
+def build_menu(menu_entries:list[MenuEntry]):
+    if not menu_entries:
+        return "#!ipxe\necho No answer files found\nshell"
+    return str(IPXEMenu(menu_entries))
+
+
+def catalog_menu(catalog, hostname, mirror=False):
+    """
+    Builds the iPXE menu from the records of an AnswersCatalog.
+    """
+    menu_entries = []
+    for record in catalog.records():
+        if record.error is not None:
+            logger.warning(f"JSON parsing error for answer file {record.path}, skipping...")
+            continue
+        entry = menu_entry(record.name, record.source, hostname, mirror)
+        if entry is not None:
+            menu_entries.append(entry)
+    return build_menu(menu_entries)
+
+
+def generate_menu(cookbook_dir, hostname, mirror=False):
     """
     Generates an iPXE menu from the answer files in the cookbook.
     """
@@ -53,61 +124,8 @@ def generate_menu(cookbook_dir, hostname):
         logger.error(f"Answer dir {answers_dir} does not exist!")
         return "#!ipxe\necho No answer files found\nshell"
 
-    menu_entries = []
-
-    answer_files = sorted(list(answers_dir.glob("*.json")))
-    if not answer_files:
+    catalog = answers_catalog(cookbook_dir)
+    catalog.refresh()
+    if not len(catalog):
         logger.error(f"No answer files found in {answers_dir}!")
-        return "#!ipxe\necho No answer files found\nshell"
-
-    for answer_file in answer_files:
-        answer_name = answer_file.stem
-        logger.debug(f"Found answer {answer_name}. Creating menu entry...")
-        with open(answer_file, "r") as f:
-            try:
-                data = json.load(f)
-                source = data.get("metadata", {}).get("source")
-                logger.debug(f"Found source {source}.")
-            except json.JSONDecodeError:
-                source = None
-                logger.error(f"Check metadata for {answer_file}. An error ocurred parsing it.")
-                logger.warning(f"JSON parsing error for answer file {f.name}, skipping...")
-                continue #Skip that shit
-
-        if source:
-            match source:
-                case uri if source.startswith("http") and source.endswith("/"):
-                    logger.debug(f"Found a URI for {answer_file} that appears to be an http repo: {uri}")
-                    kernel_url = urljoin(source, "images/pxeboot/vmlinuz")
-                    initrd_url = urljoin(source, "images/pxeboot/initrd.img")
-                    stage2_url = urljoin(source, "images/install.img")
-
-                    bootcmd = f"kernel {kernel_url} inst.ks=http://{hostname}:9000/crispin/get/{answer_name} inst.repo={source} ip=dhcp quiet\n"
-                    bootcmd += f"initrd {initrd_url}\n"
-                    bootcmd += "boot"
-
-                    menu_entry = MenuEntry(answer_name, bootcmd)
-                    menu_entries.append(menu_entry)
-
-                case uri if source.endswith(".iso"):
-                    logger.debug(f"Found URI for {answer_file} that is an ISO file: {uri}.")
-
-                case uri if source.endswith("/") and Path(source).exists():
-                    logger.debug(f"Found URI for {answer_file} that appears to be a crispin hosted file: {uri}.")
-                    kernel_url = f"http://{hostname}:9000/{source}/vmlinuz"
-                    initrd_url = f"http://{hostname}:9000/{source}/initrd.img"
-                    stage2_url = f"http://{hostname}:9000/{source}/install.img"
-
-                    bootcmd = f"kernel {kernel_url} inst.ks=http://{hostname}:9000/crispin/get/{answer_name} inst.repo={source} inst.stage2={stage2_url} ip=dhcp quiet\n"
-                    bootcmd += f"initrd {initrd_url}\n"
-                    bootcmd += "boot"
-
-                    menu_entry = MenuEntry(answer_name, bootcmd)
-                    menu_entries.append(menu_entry)
-
-                case _:
-                    logger.warning(f"Source in metadata could not be parsed! Skipping {answer_file}!")
-                    continue
-
-    menu = IPXEMenu(menu_entries)
-    return str(menu)
+    return catalog_menu(catalog, hostname, mirror)
@@ -0,0 +1,183 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from sub-millisecond cache hits up to slow
+# image transfers.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_metrics = []
+_collectors = []
+
+
+def _format_labels(labelnames, labels, extra=None):
+    pairs = list(zip(labelnames, labels))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for name, value in pairs
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    A monotonically increasing count, optionally split by labels.
+    """
+
+    def __init__(self, name: str, help: str, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, *labels, amount=1):
+        # Labels are kept as strings so the series always sort when rendered
+        labels = tuple(map(str, labels))
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    """
+    A Prometheus style histogram of observed values, optionally split by
+    labels. Observing is a bisect and a few additions under a lock.
+    """
+
+    def __init__(self, name: str, help: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        labels = tuple(map(str, labels))
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                # [per bucket counts + the +Inf bucket, sum]
+                series = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            values = sorted((labels, (list(counts), total)) for labels, (counts, total) in self._values.items())
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                bucket_labels = _format_labels(self.labelnames, labels, ("le", _format_value(bound)))
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {_format_value(total)}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+
+def register_collector(collector):
+    """
+    Registers a callable returning extra exposition lines on every scrape,
+    for values that are cheaper to read when scraped than to keep updated.
+    """
+    _collectors.append(collector)
+
+
+def render_metrics():
+    """
+    Returns every registered metric in the Prometheus text format.
+    """
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for collector in _collectors:
+        lines.extend(collector())
+    return "\n".join(lines) + "\n"
+
+
+stage_seconds = Histogram(
+    "crispin_stage_duration_seconds",
+    "Time spent in each internal stage of producing a kickstart.",
+    ("stage",),
+)
+http_requests = Counter(
+    "crispin_http_requests_total",
+    "HTTP requests handled, by route, method and status.",
+    ("route", "method", "status"),
+)
+http_request_seconds = Histogram(
+    "crispin_http_request_duration_seconds",
+    "Time from reading the request line to sending the last byte of the response.",
+    ("route", "method", "status"),
+)
+http_rejected = Counter(
+    "crispin_http_rejected_total",
+    "Connections turned away with a 503 because the server was saturated.",
+)
+admission_rejected = Counter(
+    "crispin_admission_rejected_total",
+    "Requests turned away with a 503 by admission control, by class.",
+    ("class",),
+)
+image_bytes = Counter(
+    "crispin_image_bytes_sent_total",
+    "Bytes of boot images sent to clients.",
+)
+mirror_requests = Counter(
+    "crispin_mirror_requests_total",
+    "Requests for upstream boot artifacts, by whether they were cached.",
+    ("result",),
+)
+mirror_upstream_bytes = Counter(
+    "crispin_mirror_upstream_bytes_total",
+    "Bytes of boot artifacts downloaded from upstream mirrors.",
+)
+tftp_transfers = Counter(
+    "crispin_tftp_transfers_total",
+    "TFTP transfers finished, by result.",
+    ("result",),
+)
+tftp_bytes = Counter(
+    "crispin_tftp_bytes_sent_total",
+    "Bytes of file data sent over TFTP, retransmissions included.",
+)
+
+
+def timed(stage: str):
+    """
+    Context manager timing an internal stage into stage_seconds.
+    """
+    return stage_seconds.time(stage)
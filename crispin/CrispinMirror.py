@@ -0,0 +1,423 @@
+import fcntl
+import hashlib
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+from urllib.parse import urljoin
+from crispin.CrispinMetrics import image_bytes, mirror_requests, mirror_upstream_bytes
+from crispin._util import logger
+
+MIRROR_PREFIX = "/crispin/mirror/"
+# Files of an install tree that are cached, relative to its root. Anaconda
+# reads .treeinfo to find install.img, older trees name it treeinfo.
+ARTIFACTS = frozenset((
+    "images/pxeboot/vmlinuz",
+    "images/pxeboot/initrd.img",
+    "images/install.img",
+    ".treeinfo",
+    "treeinfo",
+))
+DEFAULT_MAX_BYTES = 20 * 1024 ** 3
+READ_SIZE = 1024 * 1024
+# Seconds to wait on the upstream mirror before giving up on a download.
+UPSTREAM_TIMEOUT = 30
+# Seconds between checks on a download another worker process is making.
+FOLLOW_INTERVAL = 0.05
+# Least seconds between rescans of the answers for a key not seen before.
+REFRESH_INTERVAL = 5.0
+
+
+class UpstreamError(Exception):
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def mirror_key(source):
+    """
+    Returns the short name an install tree is cached and served under.
+    """
+    return hashlib.sha1(source.encode("utf-8")).hexdigest()[:16]
+
+
+def mirror_url(hostname, source, relpath=""):
+    """
+    Returns the URL crispin serves relpath of the install tree at source on.
+    """
+    return f"http://{hostname}:9000{MIRROR_PREFIX}{mirror_key(source)}/{relpath}"
+
+
+def is_mirrorable(source):
+    return isinstance(source, str) and source.startswith("http") and source.endswith("/")
+
+
+class _Download:
+    # One artifact being fetched from upstream into <artifact>.part next to
+    # where it will be cached. Clients follow the file as it grows, so they
+    # get the first bytes as soon as crispin does.
+    #
+    # Server worker processes share the cache. Whichever holds the flock on
+    # <artifact>.lock fetches it, the others follow its .part file until it
+    # is renamed into place. Once the .part file is created the holder
+    # writes the Content-Length, or "-" if upstream sent none, into the lock
+    # file. Until then a .part file is one left behind by a process that
+    # died, and is not followed.
+
+    def __init__(self, url, path):
+        self.url = url
+        self.path = path
+        self.part = path + ".part"
+        self.size = None
+        self.written = 0
+        self.started = False
+        self.done = False
+        self.error = None
+        self._lock = None
+        self._cond = threading.Condition()
+
+    def claim(self):
+        """
+        Tries to become the process fetching the artifact. Returns False if
+        another one already is.
+        """
+        fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        self._lock = fd
+        return True
+
+    def run(self, finished):
+        try:
+            if self._lock is not None or not self._follow():
+                self._fetch()
+        except Exception as e:
+            if isinstance(e, urllib.error.HTTPError):
+                e = UpstreamError(404 if e.code == 404 else 502, f"Upstream returned {e.code} for {self.url}")
+            elif not isinstance(e, UpstreamError):
+                e = UpstreamError(502, f"Fetching {self.url} failed: {e}")
+            logger.error(f"!!! {e}")
+            if self._lock is not None:
+                try:
+                    os.remove(self.part)
+                except FileNotFoundError:
+                    pass
+            with self._cond:
+                self.error = e
+        finally:
+            if self._lock is not None:
+                # Closing the lock file releases the flock.
+                os.ftruncate(self._lock, 0)
+                os.close(self._lock)
+                self._lock = None
+            with self._cond:
+                self.done = True
+                self._cond.notify_all()
+            finished(self)
+
+    def _fetch(self):
+        try:
+            # Another process finished it between the lookup and the claim
+            self._cached(os.stat(self.path).st_size)
+            return
+        except FileNotFoundError:
+            pass
+        try:
+            os.remove(self.part)
+        except FileNotFoundError:
+            pass
+        with urllib.request.urlopen(self.url, timeout=UPSTREAM_TIMEOUT) as response:
+            length = response.headers.get("Content-Length")
+            size = int(length) if length and length.isdigit() else None
+            fd = os.open(self.part, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            os.pwrite(self._lock, b"-" if size is None else str(size).encode(), 0)
+            with os.fdopen(fd, "wb", buffering=0) as f:
+                with self._cond:
+                    self.size = size
+                    self.started = True
+                    self._cond.notify_all()
+                while True:
+                    data = response.read(READ_SIZE)
+                    if not data:
+                        break
+                    f.write(data)
+                    mirror_upstream_bytes.inc(amount=len(data))
+                    with self._cond:
+                        self.written += len(data)
+                        self._cond.notify_all()
+        if self.size is not None and self.written != self.size:
+            raise UpstreamError(502, f"Upstream sent {self.written} of {self.size} bytes")
+        os.replace(self.part, self.path)
+        # Counts as just used, the download started a while ago.
+        os.utime(self.path)
+        logger.info(f"Cached {self.url} ({self.written} bytes).")
+
+    def _cached(self, size):
+        with self._cond:
+            self.size = self.written = size
+            self.started = True
+            self._cond.notify_all()
+
+    def _follow(self):
+        # Tracks another process fetching the artifact. Returns True once it
+        # is cached, or False after claiming the download when the other
+        # process let go of it.
+        progressed = time.monotonic()
+        while True:
+            try:
+                self._cached(os.stat(self.path).st_size)
+                return True
+            except FileNotFoundError:
+                pass
+            if not self.started:
+                with open(self.path + ".lock", "rb") as f:
+                    length = f.read()
+                if length:
+                    with self._cond:
+                        self.size = int(length) if length.isdigit() else None
+                        self.started = True
+                        self._cond.notify_all()
+            written = None
+            if self.started:
+                try:
+                    written = os.stat(self.part).st_size
+                except FileNotFoundError:
+                    pass
+            if written is not None and written > self.written:
+                with self._cond:
+                    self.written = written
+                    self._cond.notify_all()
+                progressed = time.monotonic()
+            elif self.claim():
+                # Either the other process has just renamed the file into
+                # place, which _fetch finds, or it gave up.
+                if self.started and not os.path.exists(self.path):
+                    # Clients may be part way through the abandoned file.
+                    raise UpstreamError(502, f"Another worker gave up fetching {self.url}")
+                return False
+            elif time.monotonic() - progressed > UPSTREAM_TIMEOUT:
+                raise UpstreamError(504, f"Another worker stalled fetching {self.url}")
+            time.sleep(FOLLOW_INTERVAL)
+
+    def wait_started(self):
+        """
+        Waits until upstream answered. Raises UpstreamError if it failed.
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.started or self.done, UPSTREAM_TIMEOUT):
+                raise UpstreamError(504, f"Timed out waiting for {self.url}")
+            if self.error is not None and not self.written:
+                raise self.error
+
+    def open(self):
+        # The temporary file is renamed once complete, so a reader arriving
+        # at just that moment finds it under its final name instead.
+        try:
+            return open(self.part, "rb")
+        except FileNotFoundError:
+            with self._cond:
+                if self.error is not None:
+                    raise self.error
+            return open(self.path, "rb")
+
+    def follow(self, offset):
+        """
+        Returns how many bytes from offset can be read, waiting for
+        more to be downloaded. Returns 0 at the end of the artifact.
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.written > offset or self.done, UPSTREAM_TIMEOUT):
+                raise UpstreamError(504, f"Upstream stalled on {self.url}")
+            if self.error is not None:
+                raise self.error
+            return self.written - offset
+
+
+class MirrorCache:
+    """
+    A size bounded cache on local disk of the boot artifacts of the http
+    install trees named as source in an AnswersCatalog.
+
+    Every artifact is fetched from upstream once, however many clients ask
+    for it at the same time, in this process or any other server worker
+    sharing root. While it downloads, every one of them is sent
+    what has arrived so far, and once complete it is served from disk. When
+    the cache grows beyond max_bytes the least recently used artifacts are
+    removed.
+    """
+
+    def __init__(self, root, catalog, max_bytes=DEFAULT_MAX_BYTES):
+        self.root = os.path.abspath(root)
+        self.catalog = catalog
+        self.max_bytes = max_bytes
+        self._upstreams = {}
+        self._refreshed = None
+        self._refresh_lock = threading.Lock()
+        self._downloads = {}
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+        artifacts = self._artifacts()
+        if artifacts:
+            logger.info(f"Mirror cache {self.root} holds {len(artifacts)} artifacts, {sum(size for _, _, size in artifacts)} bytes.")
+        self._evict()
+
+    def _artifacts(self):
+        # Returns (last use, path, size) of every cached artifact, oldest use
+        # first. The cache is read from disk each time rather than kept in
+        # memory, so server worker processes sharing it see each other's
+        # artifacts. Downloads abandoned by a process that died are removed.
+        artifacts = []
+        stale = time.time() - 2 * UPSTREAM_TIMEOUT
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                path = os.path.join(directory, name)
+                try:
+                    st = os.stat(path)
+                    if name.endswith(".part"):
+                        if st.st_mtime < stale:
+                            os.remove(path)
+                        continue
+                    if name.endswith(".lock"):
+                        continue
+                except FileNotFoundError:
+                    continue
+                artifacts.append((st.st_atime_ns, path, st.st_size))
+        return sorted(artifacts)
+
+    def upstream(self, key):
+        """
+        Returns the install tree a key stands for, or None if no answers
+        file names it.
+
+        An unknown key rescans the answers, at most once every
+        REFRESH_INTERVAL seconds however many clients ask for made up keys.
+        In between they are turned away from what is already known.
+        """
+        upstream = self._upstreams.get(key)
+        if upstream is None:
+            with self._refresh_lock:
+                upstream = self._upstreams.get(key)
+                now = time.monotonic()
+                if upstream is None and (self._refreshed is None or now - self._refreshed >= REFRESH_INTERVAL):
+                    self._refreshed = now
+                    self.catalog.refresh()
+                    self._upstreams = {
+                        mirror_key(record.source): record.source
+                        for record in self.catalog.records()
+                        if is_mirrorable(record.source)
+                    }
+                    upstream = self._upstreams.get(key)
+        return upstream
+
+    def lookup(self, key, relpath):
+        """
+        Returns (path, None) when an artifact is cached and (None, download)
+        when it is being downloaded, starting the download if need be.
+        Raises UpstreamError with status 404 for anything that is not a boot
+        artifact of a known install tree.
+        """
+        upstream = self.upstream(key)
+        if upstream is None or relpath not in ARTIFACTS:
+            mirror_requests.inc("error")
+            raise UpstreamError(404, "Not Found")
+        path = os.path.join(self.root, key, relpath)
+        with self._lock:
+            try:
+                # The access time orders the cache across restarts. The
+                # mtime stays put as the ETag clients resume with.
+                st = os.stat(path)
+                os.utime(path, ns=(time.time_ns(), st.st_mtime_ns))
+                mirror_requests.inc("hit")
+                return path, None
+            except FileNotFoundError:
+                pass
+            download = self._downloads.get(path)
+            if download is not None:
+                mirror_requests.inc("coalesced")
+                return None, download
+            download = _Download(urljoin(upstream, relpath), path)
+            self._downloads[path] = download
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            claimed = download.claim()
+        if claimed:
+            mirror_requests.inc("miss")
+            logger.info(f"Fetching {download.url} into the mirror cache.")
+        else:
+            mirror_requests.inc("coalesced")
+            logger.info(f"Following another worker fetching {download.url}.")
+        threading.Thread(target=download.run, args=(self._finished,), name="crispin-mirror", daemon=True).start()
+        return None, download
+
+    def _finished(self, download):
+        with self._lock:
+            self._downloads.pop(download.path, None)
+            if download.error is None:
+                self._evict()
+
+    def _evict(self):
+        # Always keeps the most recent artifact, even one larger than the
+        # whole cache. Clients still reading an evicted one keep their open
+        # file.
+        artifacts = self._artifacts()
+        total = sum(size for _, _, size in artifacts)
+        for _, path, size in artifacts[:-1]:
+            if total <= self.max_bytes:
+                break
+            total -= size
+            try:
+                os.remove(path)
+                logger.info(f"Evicted {path} from the mirror cache.")
+            except FileNotFoundError:
+                pass
+
+
+def send_download(handler, download, content_type="application/octet-stream", limiter=None):
+    """
+    Streams an artifact to the client of a BaseHTTPRequestHandler while it
+    is still being downloaded. Ranges and conditional requests are only
+    answered once it is cached.
+    """
+    download.wait_started()
+    f = download.open()
+    with f:
+        handler.send_response(200)
+        handler.send_header("Content-type", content_type)
+        if download.size is not None:
+            handler.send_header("Content-Length", str(download.size))
+        else:
+            # Without a length the end of the body is the end of the connection.
+            handler.close_connection = True
+        handler.end_headers()
+
+        offset = 0
+        try:
+            while True:
+                try:
+                    available = download.follow(offset)
+                except UpstreamError as e:
+                    # Too late for an error response, a short body tells the
+                    # client something went wrong.
+                    logger.error(f"!!! Aborting {download.url} to {handler.client_address[0]}: {e}")
+                    handler.close_connection = True
+                    return
+                if not available:
+                    return
+                while available > 0:
+                    amount = min(available, READ_SIZE if limiter is None else limiter.CHUNK_SIZE)
+                    if limiter is not None:
+                        limiter.throttle(amount)
+                    sent = handler.connection.sendfile(f, offset, amount)
+                    if sent == 0:
+                        raise BrokenPipeError("Connection closed during transfer")
+                    offset += sent
+                    available -= sent
+                    image_bytes.inc(amount=sent)
+        except (BrokenPipeError, ConnectionResetError) as e:
+            logger.info(f"Client went away while sending {download.url}: {e}")
+            handler.close_connection = True
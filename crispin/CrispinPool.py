@@ -0,0 +1,82 @@
+import json
+import queue
+import threading
+from http.server import HTTPServer
+from crispin.CrispinMetrics import http_rejected
+from crispin._util import logger
+
+
+class PooledHTTPServer(HTTPServer):
+    """
+    An HTTPServer that hands accepted connections to a fixed pool of worker
+    threads instead of handling them one at a time.
+
+    Connections wait in a queue of at most queue_depth entries for a free
+    worker. Once the queue is full new connections are answered with a 503
+    straight away so that a rack full of rebooting hosts backs off and
+    retries rather than piling up behind each other.
+    """
+
+    def __init__(self, server_address, RequestHandlerClass, threads: int = 16, queue_depth: int = 64, bind_and_activate=True, reuse_port=False):
+        if threads < 1:
+            raise ValueError("threads must be at least 1")
+        # Lets several worker processes listen on the same port, the kernel
+        # spreads new connections between them.
+        self.allow_reuse_port = reuse_port
+        self.threads = threads
+        self.queue_depth = queue_depth
+        self._requests = queue.Queue(maxsize=queue_depth)
+        self._workers = []
+        super().__init__(server_address, RequestHandlerClass, bind_and_activate)
+        for i in range(threads):
+            worker = threading.Thread(target=self._worker, name=f"crispin-http-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+        logger.info(f"Started {threads} http worker threads with a queue depth of {queue_depth}.")
+
+    def process_request(self, request, client_address):
+        try:
+            self._requests.put_nowait((request, client_address))
+        except queue.Full:
+            logger.warning(f"Request queue full, turning away {client_address[0]}.")
+            http_rejected.inc()
+            self.reject_request(request)
+
+    def reject_request(self, request):
+        body = bytes(json.dumps({"error": "Server busy, retry later"}), "utf-8")
+        response = (
+            b"HTTP/1.0 503 Service Unavailable\r\n"
+            b"Content-type: application/json\r\n"
+            b"Retry-After: 1\r\n"
+            b"Connection: close\r\n"
+            + bytes(f"Content-Length: {len(body)}\r\n\r\n", "utf-8")
+            + body
+        )
+        try:
+            request.settimeout(1)
+            request.sendall(response)
+        except OSError:
+            pass
+        finally:
+            self.shutdown_request(request)
+
+    def _worker(self):
+        while True:
+            item = self._requests.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        for _ in self._workers:
+            self._requests.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
@@ -0,0 +1,69 @@
+import cProfile
+import os
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from crispin._util import logger
+
+# Requests carrying this header set to 1 are always profiled.
+PROFILE_HEADER = "X-Crispin-Profile"
+
+_unsafe = re.compile(r"[^A-Za-z0-9_.-]+")
+# cProfile can only have one profiler active at a time on newer Pythons.
+_profiling = threading.Lock()
+
+
+def profile_path(profile_dir, recipe_name, answer_name):
+    """
+    Returns a unique pstats file name in profile_dir for a recipe and answer.
+    """
+    recipe_name = _unsafe.sub("_", str(recipe_name or "unknown"))
+    answer_name = _unsafe.sub("_", str(answer_name or "unknown"))
+    stamp = time.strftime("%Y%m%dT%H%M%S")
+    return Path(profile_dir) / f"{recipe_name}-{answer_name}-{stamp}-{os.getpid()}-{threading.get_ident()}.pstats"
+
+
+@contextmanager
+def profiled(path):
+    """
+    Runs the body under cProfile and writes the stats to path. If another
+    profile is already running the body runs unprofiled.
+    """
+    if not _profiling.acquire(blocking=False):
+        logger.info(f"Another profile is running, not writing {path}.")
+        yield None
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+        try:
+            yield profiler
+        finally:
+            profiler.disable()
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        profiler.dump_stats(str(path))
+        logger.info(f"Wrote profile to {path}.")
+    finally:
+        _profiling.release()
+
+
+class RequestProfiler:
+    """
+    Decides which kickstart requests get profiled: a sample_rate fraction of
+    them at random plus any request sending the PROFILE_HEADER header.
+    """
+
+    def __init__(self, profile_dir, sample_rate: float = 0.0):
+        self.profile_dir = Path(profile_dir)
+        self.sample_rate = sample_rate
+
+    def wanted(self, headers):
+        if headers.get(PROFILE_HEADER, "").strip() == "1":
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def profile(self, recipe_name, answer_name):
+        return profiled(profile_path(self.profile_dir, recipe_name, answer_name))
@@ -0,0 +1,148 @@
+import threading
+import time
+import weakref
+from crispin.CrispinMetrics import admission_rejected, register_collector
+from crispin._util import logger
+
+# Routes whose responses are large and slow. Everything else is a small,
+# latency critical control response.
+BULK_ROUTES = frozenset(("image",))
+
+_gates = weakref.WeakSet()
+
+
+class Saturated(Exception):
+
+    def __init__(self, retry_after):
+        super().__init__(f"Saturated, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class AdmissionGate:
+    """
+    Lets at most limit requests of one class run at once. Up to queue more
+    wait for up to timeout seconds for a slot, anything beyond that is
+    refused straight away with Saturated.
+    """
+
+    def __init__(self, name: str, limit: int, queue: int, timeout: float, retry_after: int = 1):
+        if limit < 1:
+            raise ValueError(f"{name} limit must be at least 1")
+        self.name = name
+        self.limit = limit
+        self.queue = queue
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.active = 0
+        self.waiting = 0
+        self._cond = threading.Condition()
+        _gates.add(self)
+
+    def acquire(self):
+        with self._cond:
+            if self.active < self.limit:
+                self.active += 1
+                return
+            if self.waiting >= self.queue:
+                admission_rejected.inc(self.name)
+                raise Saturated(self.retry_after)
+            self.waiting += 1
+            try:
+                deadline = time.monotonic() + self.timeout
+                while self.active >= self.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        admission_rejected.inc(self.name)
+                        raise Saturated(self.retry_after)
+                    self._cond.wait(remaining)
+                self.active += 1
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+
+class Admission:
+    """
+    Separate AdmissionGates for bulk and control routes, so a rack
+    downloading initrd.img can not hold every worker thread and kickstarts
+    and the iPXE menu always have threads left to be served on.
+    """
+
+    def __init__(self, bulk: AdmissionGate, control: AdmissionGate):
+        self.bulk = bulk
+        self.control = control
+
+    @classmethod
+    def for_threads(cls, threads: int, max_bulk=None, max_control=None, wait: float = 10.0):
+        """
+        Sizes the gates for a pool of threads. By default bulk transfers may
+        use half of the threads and queue on another quarter, leaving at
+        least a quarter of them to control routes.
+        """
+        max_bulk = max_bulk or max(1, threads // 2)
+        max_control = max_control or threads
+        reserved = max(1, threads // 4)
+        bulk_queue = max(0, threads - max_bulk - reserved)
+        return cls(
+            AdmissionGate("bulk", max_bulk, bulk_queue, wait, retry_after=5),
+            AdmissionGate("control", max_control, threads, wait, retry_after=1),
+        )
+
+    def gate(self, route: str):
+        return self.bulk if route in BULK_ROUTES else self.control
+
+
+def _admission_metrics():
+    gates = sorted(_gates, key=lambda gate: gate.name)
+    lines = []
+    for name, help, attribute in (
+        ("crispin_admission_active", "Requests currently admitted, by class.", "active"),
+        ("crispin_admission_waiting", "Requests waiting to be admitted, by class.", "waiting"),
+    ):
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} gauge")
+        for gate in gates:
+            lines.append(f'{name}{{class="{gate.name}"}} {getattr(gate, attribute)}')
+    return lines
+
+
+register_collector(_admission_metrics)
+
+
+class BandwidthLimiter:
+    """
+    Caps the combined rate of image streams at rate bytes per second and
+    shares it fairly between them.
+
+    Streams reserve each chunk on a shared timeline before sending it and
+    sleep until their slot. A stream only reserves its next chunk once the
+    last one is sent, so active streams take turns chunk by chunk, and a
+    stream held back by a slow client leaves its share to the others.
+    """
+
+    # Chunk size while limiting, small enough to interleave streams finely.
+    CHUNK_SIZE = 256 * 1024
+
+    def __init__(self, rate: float):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+        logger.info(f"Limiting image transfers to {rate * 8 / 1e6:.0f} Mbit/s.")
+
+    def throttle(self, amount: int):
+        """
+        Blocks until amount bytes may be sent.
+        """
+        with self._lock:
+            now = time.monotonic()
+            # An idle link does not build up credit for a later burst.
+            start = max(now, self._next)
+            self._next = start + amount / self.rate
+        if start > now:
+            time.sleep(start - now)
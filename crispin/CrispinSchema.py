@@ -0,0 +1,78 @@
+def _build_tree(paths):
+    # Nested (key, children) tuples, children is None for a leaf.
+    nested = {}
+    for path in paths:
+        level = nested
+        for key in path.split("."):
+            level = level.setdefault(key, {})
+    return _freeze(nested)
+
+
+def _freeze(nested):
+    return tuple((key, _freeze(sub) if sub else None) for key, sub in nested.items())
+
+
+def _all_paths(tree, prefix, out):
+    for key, children in tree:
+        path = prefix + key
+        out.append(path)
+        if children:
+            _all_paths(children, path + ".", out)
+
+
+def _missing(tree, answers, prefix, out):
+    for key, children in tree:
+        path = prefix + key
+        if not isinstance(answers, dict) or key not in answers:
+            out.append(path)
+            if children:
+                _all_paths(children, path + ".", out)
+        elif children:
+            _missing(children, answers[key], path + ".", out)
+
+
+class AnswerSchema:
+    """
+    The answers a compiled recipe requires, built once from its variables.
+
+    paths is every dotted path the recipe uses, either an iterable or a dict
+    of path to whether it is required. required is a frozenset of the
+    required paths and tree the same paths as nested tuples. Validation
+    walks the tree against the supplied answers a single time, only looking
+    at the keys the recipe actually uses. The skeleton holds every path.
+    """
+
+    __slots__ = ("required", "tree", "full_tree")
+
+    def __init__(self, paths):
+        if isinstance(paths, dict):
+            required = [path for path, is_required in paths.items() if is_required]
+        else:
+            required = paths = list(paths)
+        self.required = frozenset(required)
+        self.tree = _build_tree(required)
+        self.full_tree = _build_tree(paths)
+
+    def missing(self, answers: dict):
+        missing = []
+        _missing(self.tree, answers, "", missing)
+        return missing
+
+    def validate(self, answers: dict):
+        missing = self.missing(answers)
+        if len(missing) > 0:
+            raise ValueError(f"Answers file is missing values for: {missing}.")
+
+    def skeleton(self):
+        """
+        Returns a fresh blank answers dict for the recipe.
+        """
+        def build(tree):
+            return {key: build(children) if children else "" for key, children in tree}
+        return build(self.full_tree)
+
+    def __len__(self):
+        return len(self.required)
+
+    def __contains__(self, path):
+        return path in self.required
@@ -1,49 +1,278 @@
+import itertools
 import json
 import os
+import signal
 import threading
 import time
 import subprocess
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler
 
 from dotenv import dotenv_values
-from crispin.CrispinAPI import get_kickstart, post_kickstart
+from crispin.CrispinBatch import prerender_kickstarts, render_batch
+from crispin.CrispinAPI import RenderedKickstart, answer_recipe, open_kickstart, stream_post_kickstart
+from crispin.CrispinCache import LRUCache
+from crispin.CrispinEncoding import EncodedBody, negotiate
 from crispin.CrispinIPXE import generate_menu
-from crispin._util import logger
+from crispin.CrispinMirror import DEFAULT_MAX_BYTES, MIRROR_PREFIX, MirrorCache, UpstreamError, send_download
+from crispin.CrispinCatalog import answers_catalog
+from crispin.CrispinWatch import CookbookWatcher, MenuFile
+from crispin.CrispinWorkers import WorkerSupervisor, watch_parent
+from crispin.CrispinPool import PooledHTTPServer
+from crispin.CrispinStatic import send_file, etag_matches
+from crispin.CrispinMetrics import http_requests, http_request_seconds, render_metrics
+from crispin.CrispinProfile import RequestProfiler
+from crispin.CrispinStore import STORE_DIR, compile_cookbook
+from crispin.CrispinSchedule import Admission, BandwidthLimiter, Saturated
+from crispin.CrispinTFTP import start_tftp_thread
+from crispin._util import logger, set_log_level
+
+# The menu only changes when answers files do, so its body, ETag and
+# compressed variants are kept per version of the menu.
+menu_cache = LRUCache("menu", maxsize=4)
+
+
+def menu_body(menu):
+    """
+    Returns the EncodedBody of an iPXE menu.
+    """
+    body = menu_cache.get(menu)
+    if body is None:
+        body = EncodedBody(menu)
+        menu_cache.put(menu, body)
+    return body
+
 
 class CrispinServer(BaseHTTPRequestHandler):
 
-    def __init__(self, *args, cookbook_dir=None, hostname=None, ipxe_dir=None, ipxe_menu=None, **kwargs):
+    # HTTP/1.1 is needed to stream kickstarts with chunked transfer encoding,
+    # every response therefore sends a Content-Length or is chunked. It also
+    # makes every route keep connections alive unless the client asks for
+    # Connection: close, where HTTP/1.0 closed them after each response.
+    # Clients fetching a menu, kernel, initrd and kickstart in a row reuse
+    # one connection instead of opening one per request.
+    protocol_version = "HTTP/1.1"
+    # Seconds a client may stall part way through a request or response.
+    timeout = 30
+    # Seconds a kept alive connection may sit idle between requests, and the
+    # number of requests served on one connection before it is closed. An
+    # idle connection holds on to a worker thread so both are kept short.
+    keepalive_timeout = 5
+    keepalive_requests = 100
+    # Headers and body go out as separate writes. With Nagle's algorithm the
+    # body waits for the client to ACK the headers, which it delays by up to
+    # 40ms, on every request after the first on a kept alive connection.
+    disable_nagle_algorithm = True
+
+    def __init__(self, *args, cookbook_dir=None, hostname=None, ipxe_dir=None, ipxe_menu=None, profiler=None, keepalive_timeout=None, keepalive_requests=None, admission=None, bandwidth=None, mirror=None, batch_jobs=None, **kwargs):
+        self.batch_jobs = batch_jobs
+        self.mirror = mirror
+        self.admission = admission
+        self.bandwidth = bandwidth
+        if keepalive_timeout is not None:
+            self.keepalive_timeout = keepalive_timeout
+        if keepalive_requests is not None:
+            self.keepalive_requests = keepalive_requests
+        self._requests_served = 0
         self.cookbook_dir = cookbook_dir
+        self.profiler = profiler
         self.hostname = hostname
         self.ipxe_dir = ipxe_dir
-        self.ipxe_menu = ipxe_menu or generate_menu(cookbook_dir, hostname)
+        self.ipxe_menu = ipxe_menu or generate_menu(cookbook_dir, hostname, mirror=mirror is not None)
         super().__init__(*args, **kwargs)
 
-        
+    def route(self):
+        """
+        Returns the route label the current request is counted under.
+        """
+        # A malformed request line leaves path unset
+        path = getattr(self, "path", "").split("?", 1)[0]
+        if path.startswith("/crispin/get/"):
+            return "kickstart"
+        if path == "/autoexec.ipxe":
+            return "menu"
+        if path.endswith(("/vmlinuz", "/initrd.img")) or path.startswith(MIRROR_PREFIX):
+            return "image"
+        if path == "/metrics":
+            return "metrics"
+        if path == "/crispin/batch":
+            return "batch"
+        return "other"
+
+    def parse_request(self):
+        self._started = time.perf_counter()
+        self._status = None
+        # A request has started, allow for slow clients again.
+        self.connection.settimeout(self.timeout)
+        return super().parse_request()
+
+    def send_response(self, code, message=None):
+        self._status = code
+        super().send_response(code, message)
+
+    def end_headers(self):
+        # Tell clients how long the connection stays open, or that it is
+        # being closed after this response once it has served its quota.
+        if not self.close_connection:
+            remaining = self.keepalive_requests - self._requests_served - 1
+            if remaining <= 0:
+                self.send_header("Connection", "close")
+            else:
+                self.send_header("Connection", "keep-alive")
+                self.send_header("Keep-Alive", f"timeout={self.keepalive_timeout:g}, max={remaining}")
+        super().end_headers()
+
+    def handle_one_request(self):
+        self._started = None
+        if self._requests_served:
+            self.connection.settimeout(self.keepalive_timeout)
+        super().handle_one_request()
+        self._requests_served += 1
+        # Only requests that got as far as a response are counted, not idle
+        # keep-alive connections timing out nor request lines too malformed
+        # to have a method.
+        if self._started is not None and self._status is not None and getattr(self, "command", None):
+            labels = (self.route(), self.command, str(self._status))
+            http_requests.inc(*labels)
+            http_request_seconds.observe(time.perf_counter() - self._started, *labels)
+
     def send_json_error(self, code, message):
+        body = bytes(json.dumps({"error": message}), "utf-8")
         self.send_response(code)
         self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_stream(self, chunks, content_type="text/plain"):
+        """
+        Sends a generator of bytes as the response body. HTTP/1.1 clients get
+        chunked transfer encoding, HTTP/1.0 clients a body ended by closing
+        the connection.
+
+        The first chunk is produced before the status line is sent so that a
+        template failing straight away still gets a proper error response.
+        Later failures can only cut the transfer short.
+        """
+        first = next(chunks, b"")
+        chunked = self.request_version != "HTTP/1.0"
+        self.send_response(200)
+        self.send_header("Content-type", content_type)
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        else:
+            self.send_header("Connection", "close")
         self.end_headers()
-        self.wfile.write(bytes(json.dumps({"error": message}), "utf-8"))
+        try:
+            for chunk in itertools.chain((first,), chunks):
+                if not chunk:
+                    continue
+                if chunked:
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                else:
+                    self.wfile.write(chunk)
+            if chunked:
+                self.wfile.write(b"0\r\n\r\n")
+        except Exception as e:
+            logger.error(f"!!! Stream to {self.client_address[0]} aborted: {e}")
+            self.close_connection = True
+
+    def profiling(self):
+        return self.profiler is not None and self.profiler.wanted(self.headers)
+
+    def send_body(self, encoded_body, content_type="text/plain"):
+        """
+        Sends an EncodedBody in the content coding the client prefers, or a
+        304 if the client already has that variant.
+        """
+        encoding = negotiate(self.headers.get("Accept-Encoding"))
+        body, etag, encoding = encoded_body.encoded(encoding)
+        if etag_matches(self.headers, etag):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Vary", "Accept-Encoding")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-type", content_type)
+        if encoding is not None:
+            self.send_header("Content-Encoding", encoding)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Vary", "Accept-Encoding")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_kickstart(self, answer_name, cached=True):
+        rendered = open_kickstart(answer_name, self.cookbook_dir, cached)
+        if not isinstance(rendered, RenderedKickstart):
+            # Too large to keep whole, streamed as it renders.
+            self.send_stream(rendered)
+            return
+        self.send_body(rendered)
+
+    def admitted(self, serve):
+        """
+        Runs serve once admission control lets the request through, or
+        answers with a 503 and a Retry-After if it is saturated.
+        """
+        if self.admission is None:
+            return serve()
+        gate = self.admission.gate(self.route())
+        try:
+            gate.acquire()
+        except Saturated as e:
+            logger.warning(f"Admission control turning away {self.client_address[0]} for {self.path}.")
+            if self.command == "POST":
+                # The unread body would be taken for the next request.
+                self.close_connection = True
+            body = bytes(json.dumps({"error": "Server busy, retry later"}), "utf-8")
+            self.send_response(503)
+            self.send_header("Content-type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("Retry-After", str(e.retry_after))
+            if self.close_connection:
+                self.send_header("Connection", "close")
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        try:
+            return serve()
+        finally:
+            gate.release()
 
     def do_GET(self):
+        self.admitted(self.serve_get)
+
+    def do_POST(self):
+        self.admitted(self.serve_post)
+
+    def serve_get(self):
         if self.path.startswith("/crispin/get/"):
             answer_name = self.path.split("/")[-1]
             try:
-                kickstart = get_kickstart(answer_name, self.cookbook_dir)
-                self.send_response(200)
-                self.send_header("Content-type", "text/plain")
-                self.end_headers()
-                self.wfile.write(bytes(kickstart, "utf-8"))
+                if self.profiling():
+                    # Render from scratch, a profile of a cache hit shows nothing
+                    with self.profiler.profile(answer_recipe(answer_name, self.cookbook_dir), answer_name):
+                        self.send_kickstart(answer_name, cached=False)
+                else:
+                    self.send_kickstart(answer_name)
             except FileNotFoundError as e:
                 self.send_json_error(404, str(e))
             except Exception as e:
                 self.send_json_error(500, str(e))
-        elif self.path == "/autoexec.ipxe":
+        elif self.path == "/metrics":
+            body = bytes(render_metrics(), "utf-8")
             self.send_response(200)
-            self.send_header("Content-type", "text/plain")
+            self.send_header("Content-type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
             self.end_headers()
-            self.wfile.write(bytes(self.ipxe_menu, "utf-8"))
+            self.wfile.write(body)
+        elif self.path == "/autoexec.ipxe":
+            self.send_body(menu_body(self.ipxe_menu))
+        elif self.path.startswith(MIRROR_PREFIX) and self.mirror is not None:
+            self.send_mirrored()
         elif self.path.endswith(("/vmlinuz", "/initrd.img")):
             safe_path = os.path.abspath(os.path.join(self.ipxe_dir, self.path.lstrip('/')))
             if not safe_path.startswith(os.path.abspath(self.ipxe_dir)):
@@ -51,34 +280,74 @@ class CrispinServer(BaseHTTPRequestHandler):
                 return
 
             try:
-                with open(safe_path, "rb") as f:
-                    self.send_response(200)
-                    self.send_header("Content-type", "application/octet-stream")
-                    self.end_headers()
-                    self.wfile.write(f.read())
+                send_file(self, safe_path, limiter=self.bandwidth)
             except FileNotFoundError:
                 self.send_json_error(404, "File not found")
         else:
             self.send_json_error(404, "Not Found")
 
-    def do_POST(self):
+    def send_mirrored(self):
+        """
+        Sends a boot artifact of an upstream install tree from the mirror
+        cache, or while it is being fetched into it.
+        """
+        key, _, relpath = self.path.split("?", 1)[0][len(MIRROR_PREFIX):].partition("/")
+        try:
+            path, download = self.mirror.lookup(key, relpath)
+            if path is not None:
+                send_file(self, path, limiter=self.bandwidth)
+            else:
+                send_download(self, download, limiter=self.bandwidth)
+        except UpstreamError as e:
+            self.send_json_error(e.status, str(e))
+        except FileNotFoundError:
+            # Evicted between the lookup and opening it
+            self.send_json_error(503, "Artifact was evicted, retry")
+
+    def read_body(self):
+        """
+        Reads the request body. Without a usable Content-Length the body can
+        not be skipped either, so the connection is closed after responding.
+        """
+        try:
+            content_length = int(self.headers["Content-Length"])
+            if content_length < 0:
+                raise ValueError
+        except (TypeError, ValueError):
+            self.close_connection = True
+            raise ValueError("Missing or invalid Content-Length")
+        return self.rfile.read(content_length)
+
+    def serve_post(self):
         if self.path.startswith("/crispin/get/"):
             recipe_name = self.path.split("/")[-1]
             try:
-                content_length = int(self.headers['Content-Length'])
-                post_data = self.rfile.read(content_length)
-                kickstart = post_kickstart(recipe_name, post_data, self.cookbook_dir)
-                self.send_response(200)
-                self.send_header("Content-type", "text/plain")
-                self.end_headers()
-                self.wfile.write(bytes(kickstart, "utf-8"))
+                post_data = self.read_body()
+                if self.profiling():
+                    with self.profiler.profile(recipe_name, "post"):
+                        self.send_stream(stream_post_kickstart(recipe_name, post_data, self.cookbook_dir))
+                else:
+                    self.send_stream(stream_post_kickstart(recipe_name, post_data, self.cookbook_dir))
             except FileNotFoundError as e:
                 self.send_json_error(404, str(e))
             except ValueError as e:
                 self.send_json_error(400, str(e))
             except Exception as e:
                 self.send_json_error(500, str(e))
+        elif self.path == "/crispin/batch":
+            try:
+                try:
+                    items = json.loads(self.read_body())
+                except json.JSONDecodeError:
+                    raise ValueError("Invalid JSON in request body")
+                self.send_stream(render_batch(items, self.cookbook_dir, self.batch_jobs), content_type="application/x-ndjson")
+            except ValueError as e:
+                self.send_json_error(400, str(e))
+            except Exception as e:
+                self.send_json_error(500, str(e))
         else:
+            # The unread body would be taken for the next request.
+            self.close_connection = True
             self.send_json_error(404, "Not Found")
 
 def start_standalone_tftp(root_dir, port=6969):
@@ -121,7 +390,82 @@ def start_standalone_tftp(root_dir, port=6969):
     except FileNotFoundError:
         logger.error("[!] Error: 'in.tftpd' not found. Install it with 'sudo apt install tftpd-hpa'")
 
-def run(server_class=HTTPServer, handler_class=CrispinServer, port=9000, cookbook_dir=None, ipxe_dir=None ):
+def prerender_cookbook(cookbook_dir, jobs=None):
+    """
+    Pre-renders every answers file's kickstart into the render cache while
+    the server starts, reporting any that fail to render.
+    """
+    start = time.perf_counter()
+    rendered, failures = prerender_kickstarts(cookbook_dir, jobs)
+    logger.info(f"Pre-rendered {len(rendered)} kickstarts in {time.perf_counter() - start:.2f}s.")
+    if failures:
+        logger.error(f"!!! {len(failures)} answers files can not be rendered: {', '.join(sorted(f.stem for f in failures))}")
+
+
+def make_server(server_class=PooledHTTPServer, handler_class=CrispinServer, port=9000, cookbook_dir=None, ipxe_dir=None, hostname="localhost", menu=None, threads=16, queue_depth=64, profile_dir=None, profile_rate=0.0, keepalive_timeout=5, keepalive_requests=100, max_bulk=None, max_control=None, admission_wait=10.0, image_bandwidth=None, mirror=False, mirror_dir=None, mirror_size=None, batch_jobs=None, reuse_port=False):
+    """
+    Builds the HTTP server. menu is called for the current iPXE menu, without
+    it the menu is generated for every connection.
+    """
+    if menu is None:
+        menu = lambda: None
+    profiler = None
+    if profile_dir is not None:
+        logger.info(f"Profiling {profile_rate:.1%} of kickstart requests into {profile_dir}.")
+        profiler = RequestProfiler(profile_dir, profile_rate)
+
+    mirror_cache = None
+    if mirror:
+        mirror_dir = mirror_dir or os.path.join(cookbook_dir, STORE_DIR, "mirror")
+        mirror_cache = MirrorCache(mirror_dir, answers_catalog(cookbook_dir), mirror_size or DEFAULT_MAX_BYTES)
+        logger.info(f"Caching upstream boot artifacts in {mirror_dir}, up to {mirror_cache.max_bytes} bytes.")
+
+    admission = Admission.for_threads(threads, max_bulk, max_control, admission_wait)
+    logger.info(f"Admitting {admission.bulk.limit} image transfers and {admission.control.limit} other requests at once.")
+    bandwidth = BandwidthLimiter(image_bandwidth) if image_bandwidth else None
+
+    def handler_wrapper(*args, **kwargs):
+        return handler_class(*args, cookbook_dir=cookbook_dir, hostname=hostname, ipxe_dir=ipxe_dir, ipxe_menu=menu(), profiler=profiler, keepalive_timeout=keepalive_timeout, keepalive_requests=keepalive_requests, admission=admission, bandwidth=bandwidth, mirror=mirror_cache, batch_jobs=batch_jobs, **kwargs)
+
+    server_address = ('', port)
+    if issubclass(server_class, PooledHTTPServer):
+        return server_class(server_address, handler_wrapper, threads=threads, queue_depth=queue_depth, reuse_port=reuse_port)
+    return server_class(server_address, handler_wrapper)
+
+
+def serve_worker(server_options, log_level, prerender, jobs, ready):
+    """
+    Runs one worker process of a server started with several workers. It
+    listens on the shared port until SIGTERM, then stops accepting and
+    finishes the requests it already has. The menu is read from the
+    autoexec.ipxe the supervisor keeps up to date.
+    """
+    set_log_level(log_level)
+    # The supervisor decides when workers stop and restart.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    menu_file = MenuFile(server_options["ipxe_dir"])
+    httpd = make_server(menu=menu_file.read, reuse_port=True, **server_options)
+
+    def stop(*_):
+        # shutdown() waits for serve_forever to return, so it can not be
+        # called from the thread running it.
+        threading.Thread(target=httpd.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    watch_parent(stop)
+    if prerender:
+        threading.Thread(target=prerender_cookbook, args=(server_options["cookbook_dir"], jobs), name="crispin-prerender", daemon=True).start()
+    ready.send(True)
+    ready.close()
+    logger.info(f"Worker {os.getpid()} listening on port {server_options['port']}.")
+    httpd.serve_forever()
+    httpd.server_close()
+    logger.info(f"Worker {os.getpid()} stopped.")
+
+
+def run(server_class=PooledHTTPServer, handler_class=CrispinServer, port=9000, cookbook_dir=None, ipxe_dir=None, threads=16, queue_depth=64, watch=True, profile_dir=None, profile_rate=0.0, prerender=False, keepalive_timeout=5, keepalive_requests=100, tftp="in.tftpd", tftp_port=6969, max_bulk=None, max_control=None, admission_wait=10.0, image_bandwidth=None, mirror=False, mirror_dir=None, mirror_size=None, batch_jobs=None, workers=1):
 
     config = dotenv_values(".env")
     hostname = config.get("HOSTNAME", "localhost")
@@ -130,23 +474,62 @@ def run(server_class=HTTPServer, handler_class=CrispinServer, port=9000, cookboo
     if ipxe_dir is None:
         raise ValueError("ipxe_dir must be provided")
 
-    # Generate autoexec.ipxe menu
-    ipxe_menu = generate_menu(cookbook_dir, hostname)
+    # Generate autoexec.ipxe menu, rewritten by the watcher as answers change
     logger.info("Generating autoexec.ipxe...")
-    with open(f"{ipxe_dir}/autoexec.ipxe", "w") as f:
-        f.write(ipxe_menu)
+    watcher = CookbookWatcher(cookbook_dir, hostname, ipxe_dir, mirror=mirror)
+    watcher.load()
 
-    os.chmod(f"{ipxe_dir}/autoexec.ipxe", 0o777) #Octal bby
+    if workers > 1:
+        # Compiled once here rather than by every worker.
+        logger.info(f"Compiling the cookbook for the workers into {os.path.join(cookbook_dir, STORE_DIR)}...")
+        try:
+            _, failures = compile_cookbook(cookbook_dir)
+            if failures:
+                logger.error(f"!!! {len(failures)} recipes can not be compiled: {', '.join(sorted(recipe.stem for recipe, _ in failures))}")
+        except OSError as e:
+            logger.warning(f"Can not store the compiled cookbook, every worker compiles recipes in memory: {e}")
+    elif prerender:
+        threading.Thread(target=prerender_cookbook, args=(cookbook_dir,), name="crispin-prerender", daemon=True).start()
+
+    if watch:
+        logger.info(f"Watching {cookbook_dir} for changes.")
+        watcher.start()
 
     # Start TFTP server in a separate thread
-    logger.info("Starting in.tftpd on port 6969.")
-    tftp_thread = threading.Thread(target=start_standalone_tftp, args=(ipxe_dir, 6969), daemon=True)
-    tftp_thread.start()
-    def handler_wrapper(*args, **kwargs):
-        return handler_class(*args, cookbook_dir=cookbook_dir, hostname=hostname, ipxe_dir=ipxe_dir, ipxe_menu=ipxe_menu, **kwargs)
+    match tftp:
+        case "builtin":
+            logger.info(f"Starting the built in TFTP server on port {tftp_port}.")
+            start_tftp_thread(ipxe_dir, tftp_port, menu=lambda: watcher.menu)
+        case "in.tftpd":
+            logger.info(f"Starting in.tftpd on port {tftp_port}.")
+            tftp_thread = threading.Thread(target=start_standalone_tftp, args=(ipxe_dir, tftp_port), daemon=True)
+            tftp_thread.start()
+        case _:
+            logger.info("Not starting a TFTP server.")
 
-    server_address = ('', port)
-    httpd = server_class(server_address, handler_wrapper)
+    server_options = dict(
+        server_class=server_class, handler_class=handler_class, port=port, cookbook_dir=cookbook_dir, ipxe_dir=ipxe_dir,
+        hostname=hostname, threads=threads, queue_depth=queue_depth, profile_dir=profile_dir, profile_rate=profile_rate,
+        keepalive_timeout=keepalive_timeout, keepalive_requests=keepalive_requests, max_bulk=max_bulk,
+        max_control=max_control, admission_wait=admission_wait, image_bandwidth=image_bandwidth, mirror=mirror,
+        mirror_dir=mirror_dir, mirror_size=mirror_size, batch_jobs=batch_jobs,
+    )
+
+    if workers > 1:
+        # Process pools in the workers share the cores between them.
+        jobs = max(1, (os.cpu_count() or 1) // workers)
+        if batch_jobs is None:
+            server_options["batch_jobs"] = jobs
+        if image_bandwidth:
+            # Every worker paces its own transfers.
+            server_options["image_bandwidth"] = image_bandwidth / workers
+        logger.info(f"Starting {workers} workers on port {port}...")
+        supervisor = WorkerSupervisor(workers, serve_worker, (server_options, logger.level, prerender, jobs))
+        if not supervisor.run():
+            raise SystemExit(1)
+        return
+
+    httpd = make_server(menu=lambda: watcher.menu, **server_options)
     logger.info(f"Starting httpd on port {port}...")
     httpd.serve_forever()
 
@@ -0,0 +1,182 @@
+import os
+import re
+from email.utils import formatdate, parsedate_to_datetime
+from crispin.CrispinEncoding import SUFFIXES, negotiate
+from crispin.CrispinMetrics import image_bytes
+from crispin._util import logger
+
+# Files are sent in pieces of this size so that a download never needs more
+# than a chunk's worth of memory, however large the image is.
+CHUNK_SIZE = 1024 * 1024
+
+_range_re = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def file_etag(st):
+    return f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+
+
+def parse_range(header, size):
+    """
+    Parses a Range header into an inclusive (start, end) byte range.
+
+    Returns None when the whole file should be sent, which is also the case
+    for malformed or multi-range headers as RFC 9110 allows a server to
+    ignore those. Raises RangeNotSatisfiable when the range lies outside the
+    file.
+    """
+    if not header:
+        return None
+    match = _range_re.match(header.strip())
+    if not match:
+        return None
+    start, end = match.groups()
+    if start == "" and end == "":
+        return None
+    if start == "":
+        # bytes=-N is the last N bytes of the file
+        length = int(end)
+        if length == 0:
+            raise RangeNotSatisfiable()
+        return max(size - length, 0), size - 1
+    start = int(start)
+    end = size - 1 if end == "" else min(int(end), size - 1)
+    if start >= size or start > end:
+        raise RangeNotSatisfiable()
+    return start, end
+
+
+def etag_matches(headers, etag):
+    """
+    Returns True when the If-None-Match header of a request matches etag.
+    """
+    if_none_match = headers.get("If-None-Match")
+    if if_none_match is None:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
+def _not_modified(headers, etag, mtime):
+    if headers.get("If-None-Match") is not None:
+        return etag_matches(headers, etag)
+    if_modified_since = headers.get("If-Modified-Since")
+    if if_modified_since is not None:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def _range_applies(headers, etag, last_modified):
+    # A Range is only honoured when If-Range, if sent, still matches the file.
+    if_range = headers.get("If-Range")
+    if if_range is None:
+        return True
+    return if_range.strip() in (etag, last_modified)
+
+
+def _precompressed(path, accept_encoding):
+    # Returns the precompressed sibling of path to send and its coding, if
+    # the client accepts one that is smaller and at least as new as path
+    # itself, and whether the response varies by Accept-Encoding.
+    siblings = {}
+    st = None
+    for encoding, suffix in SUFFIXES.items():
+        try:
+            sibling = os.stat(path + suffix)
+        except OSError:
+            continue
+        if st is None:
+            st = os.stat(path)
+        if sibling.st_mtime_ns >= st.st_mtime_ns and sibling.st_size < st.st_size:
+            siblings[encoding] = path + suffix
+    encoding = negotiate(accept_encoding, [e for e in SUFFIXES if e in siblings])
+    if encoding is None:
+        return path, None, bool(siblings)
+    return siblings[encoding], encoding, True
+
+
+def send_file(handler, path, content_type="application/octet-stream", limiter=None):
+    """
+    Streams a file to the client of a BaseHTTPRequestHandler.
+
+    Supports conditional requests through ETag/If-None-Match and
+    Last-Modified/If-Modified-Since and partial transfers through Range so
+    that interrupted downloads can be resumed. A path.gz or path.zst next to
+    the file is sent instead to clients accepting that coding. A
+    BandwidthLimiter paces the transfer against every other one using it.
+    """
+    path, encoding, varies = _precompressed(path, handler.headers.get("Accept-Encoding"))
+    with open(path, "rb") as f:
+        st = os.fstat(f.fileno())
+        size = st.st_size
+        etag = file_etag(st)
+        last_modified = formatdate(st.st_mtime, usegmt=True)
+
+        if _not_modified(handler.headers, etag, st.st_mtime):
+            handler.send_response(304)
+            handler.send_header("ETag", etag)
+            handler.send_header("Last-Modified", last_modified)
+            if varies:
+                handler.send_header("Vary", "Accept-Encoding")
+            handler.end_headers()
+            return
+
+        try:
+            byte_range = None
+            if _range_applies(handler.headers, etag, last_modified):
+                byte_range = parse_range(handler.headers.get("Range"), size)
+        except RangeNotSatisfiable:
+            handler.send_response(416)
+            handler.send_header("Content-Range", f"bytes */{size}")
+            handler.send_header("Content-Length", "0")
+            handler.end_headers()
+            return
+
+        if byte_range is None:
+            start, end = 0, size - 1
+            handler.send_response(200)
+        else:
+            start, end = byte_range
+            handler.send_response(206)
+            handler.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        length = end - start + 1
+
+        handler.send_header("Content-type", content_type)
+        if encoding is not None:
+            handler.send_header("Content-Encoding", encoding)
+        if varies:
+            handler.send_header("Vary", "Accept-Encoding")
+        handler.send_header("Content-Length", str(length))
+        handler.send_header("Accept-Ranges", "bytes")
+        handler.send_header("ETag", etag)
+        handler.send_header("Last-Modified", last_modified)
+        handler.end_headers()
+
+        try:
+            _copy_to_socket(handler.connection, f, start, length, limiter)
+        except (BrokenPipeError, ConnectionResetError) as e:
+            logger.info(f"Client went away while sending {path}: {e}")
+            handler.close_connection = True
+
+
+def _copy_to_socket(sock, f, offset, length, limiter=None):
+    # socket.sendfile uses os.sendfile where it can and falls back to plain
+    # reads and sends otherwise, either way only one chunk is in flight.
+    chunk_size = CHUNK_SIZE if limiter is None else limiter.CHUNK_SIZE
+    while length > 0:
+        amount = min(chunk_size, length)
+        if limiter is not None:
+            limiter.throttle(amount)
+        sent = sock.sendfile(f, offset, amount)
+        if sent == 0:
+            raise BrokenPipeError("Connection closed during transfer")
+        offset += sent
+        length -= sent
+        image_bytes.inc(amount=sent)
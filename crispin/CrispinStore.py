@@ -0,0 +1,107 @@
+import marshal
+import os
+import sys
+from pathlib import Path
+import jinja2
+from crispin.CrispinCache import is_fresh
+from crispin._util import logger
+
+# Bump when the layout of a stored record changes.
+STORE_VERSION = 3
+STORE_DIR = ".crispin"
+
+
+def _runtime():
+    # Code objects are only valid for the Python and Jinja2 that made them.
+    return (STORE_VERSION, sys.implementation.cache_tag, jinja2.__version__)
+
+
+def store_path(recipe, ks_logging: bool = False):
+    """
+    Returns where the compiled form of a recipe in <cookbook>/recipes is
+    stored, <cookbook>/.crispin/compiled/<recipe>.bin.
+    """
+    recipe = Path(recipe)
+    suffix = "-logging" if ks_logging else ""
+    return recipe.parent.parent / STORE_DIR / "compiled" / f"{recipe.stem}{suffix}.bin"
+
+
+def write_record(recipe, template_path, ks_logging, compiled):
+    """
+    Stores a CompiledRecipe's source, variables and Jinja2 code object.
+    """
+    path = store_path(recipe, ks_logging)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    record = {
+        "runtime": _runtime(),
+        "template_path": os.path.abspath(template_path),
+        "fingerprint": compiled.fingerprint,
+        "composed": compiled.composed,
+        "source": compiled.source,
+        "variables": dict(compiled.variables),
+        "code": compiled.code,
+    }
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "wb") as f:
+        marshal.dump(record, f)
+    os.replace(tmp_path, path)
+    return path
+
+
+def read_record(recipe, template_path, ks_logging: bool = False):
+    """
+    Returns the stored record for a recipe, or None if there is none or it
+    is stale: made by another Python or Jinja2, for another template dir, or
+    any file it was built from has changed since.
+    """
+    path = store_path(recipe, ks_logging)
+    try:
+        with open(path, "rb") as f:
+            record = marshal.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, EOFError, ValueError, TypeError) as e:
+        logger.warning(f"Ignoring unreadable compiled recipe {path}: {e}")
+        return None
+
+    if (
+        not isinstance(record, dict)
+        or record.get("runtime") != _runtime()
+        or record.get("template_path") != os.path.abspath(template_path)
+        or not is_fresh(record.get("fingerprint", ()))
+    ):
+        logger.debug(f"Compiled recipe {path} is stale.")
+        return None
+    return record
+
+
+def compile_cookbook(cookbook_dir, ks_logging_variants=(False,)):
+    """
+    Compiles every recipe in a cookbook into the store. Returns a dict of
+    recipe file to stored path and a dict of recipe file to the exception it
+    failed with, template syntax errors included. Raises OSError if the
+    store can not be written, a read only cookbook for example.
+    """
+    from crispin.CrispinGenerate import build_compiled_recipe
+
+    cookbook_dir = Path(cookbook_dir)
+    template_path = cookbook_dir / "templates"
+    # Fragments are kept as bytecode next to the recipes once this exists.
+    (cookbook_dir / STORE_DIR).mkdir(exist_ok=True)
+    stored = {}
+    failures = {}
+    for recipe in sorted((cookbook_dir / "recipes").glob("*.json")):
+        for ks_logging in ks_logging_variants:
+            try:
+                compiled = build_compiled_recipe(recipe, template_path, ks_logging)
+            except jinja2.TemplateSyntaxError as e:
+                logger.error(f"!!! {recipe}: {e.message} on line {e.lineno} of the master template")
+                failures[(recipe, ks_logging)] = e
+                continue
+            except Exception as e:
+                logger.error(f"!!! {recipe}: {e}")
+                failures[(recipe, ks_logging)] = e
+                continue
+            # Not a failure of the recipe, no other one could be stored either
+            stored[(recipe, ks_logging)] = write_record(recipe, template_path, ks_logging, compiled)
+    return stored, failures
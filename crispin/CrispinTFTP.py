@@ -0,0 +1,338 @@
+import asyncio
+import mmap
+import os
+import struct
+import threading
+from crispin.CrispinMetrics import tftp_bytes, tftp_transfers
+from crispin._util import logger
+
+# RFC 1350 opcodes
+RRQ, WRQ, DATA, ACK, ERROR, OACK = 1, 2, 3, 4, 5, 6
+
+# RFC 1350 error codes
+ERR_UNDEFINED = 0
+ERR_NOT_FOUND = 1
+ERR_ACCESS = 2
+ERR_ILLEGAL = 4
+ERR_UNKNOWN_TID = 5
+ERR_OPTIONS = 8
+
+DEFAULT_BLKSIZE = 512
+# Largest block that fits a 1500 byte Ethernet frame without fragmenting.
+MAX_BLKSIZE = 1468
+MAX_WINDOWSIZE = 64
+DEFAULT_TIMEOUT = 1.0
+MAX_RETRIES = 5
+
+MENU_NAME = "autoexec.ipxe"
+
+
+class TFTPError(Exception):
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+class TransferAborted(Exception):
+    pass
+
+
+def error_packet(code, message):
+    return struct.pack("!HH", ERROR, code) + message.encode("ascii", "replace") + b"\0"
+
+
+def parse_request(packet):
+    """
+    Parses a RRQ or WRQ into (opcode, filename, mode, options) with the
+    option names lower cased.
+    """
+    opcode = struct.unpack("!H", packet[:2])[0]
+    fields = packet[2:].split(b"\0")
+    # A well formed request ends in a NUL, leaving an empty last field.
+    if len(fields) < 3 or fields[-1] != b"":
+        raise TFTPError(ERR_ILLEGAL, "Malformed request")
+    fields = [field.decode("ascii", "replace") for field in fields[:-1]]
+    filename, mode = fields[0], fields[1].lower()
+    options = {}
+    for name, value in zip(fields[2::2], fields[3::2]):
+        options[name.lower()] = value
+    return opcode, filename, mode, options
+
+
+def negotiate_options(options, size, max_blksize=MAX_BLKSIZE, max_windowsize=MAX_WINDOWSIZE):
+    """
+    Returns the blksize (RFC 2348), tsize (RFC 2349), timeout (RFC 2349)
+    and windowsize (RFC 7440) options accepted for a transfer, clamped to
+    what this server allows. Unknown and invalid options are ignored.
+    """
+    accepted = {}
+    try:
+        if "blksize" in options:
+            blksize = int(options["blksize"])
+            if blksize >= 8:
+                accepted["blksize"] = min(blksize, max_blksize, 65464)
+        if "tsize" in options:
+            accepted["tsize"] = size
+        if "timeout" in options:
+            timeout = int(options["timeout"])
+            if 1 <= timeout <= 255:
+                accepted["timeout"] = timeout
+        if "windowsize" in options:
+            windowsize = int(options["windowsize"])
+            if windowsize >= 1:
+                accepted["windowsize"] = min(windowsize, max_windowsize, 65535)
+    except ValueError:
+        pass
+    return accepted
+
+
+def resolve(root, filename):
+    """
+    Returns the real path of filename under root. Absolute names are taken
+    relative to root and anything resolving outside of it, through .. or a
+    symlink, raises TFTPError.
+    """
+    root = os.path.realpath(root)
+    path = os.path.realpath(os.path.join(root, filename.replace("\\", "/").lstrip("/")))
+    if os.path.commonpath((root, path)) != root:
+        raise TFTPError(ERR_ACCESS, "Access violation")
+    return path
+
+
+class _TransferProtocol(asyncio.DatagramProtocol):
+    # The endpoint a single transfer talks to its client through. Packets
+    # from anyone but the client are answered with an unknown TID error.
+
+    def __init__(self, client):
+        self.client = client
+        self.packets = asyncio.Queue()
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if addr != self.client:
+            self.transport.sendto(error_packet(ERR_UNKNOWN_TID, "Unknown transfer ID"), addr)
+            return
+        self.packets.put_nowait(data)
+
+    def error_received(self, exc):
+        logger.debug(f"TFTP transfer to {self.client[0]} got {exc}")
+
+
+class _Transfer:
+    # Sends one file to one client, in windows of windowsize blocks.
+
+    def __init__(self, protocol, data, filename, options, retries):
+        self.protocol = protocol
+        self.data = data
+        self.filename = filename
+        self.options = options
+        self.blksize = options.get("blksize", DEFAULT_BLKSIZE)
+        self.windowsize = options.get("windowsize", 1)
+        self.timeout = options.get("timeout", DEFAULT_TIMEOUT)
+        self.retries = retries
+        self.sent = 0
+
+    def _send(self, packet):
+        self.protocol.transport.sendto(packet, self.protocol.client)
+
+    def _block(self, number):
+        start = (number - 1) * self.blksize
+        return struct.pack("!HH", DATA, number & 0xFFFF) + self.data[start:start + self.blksize]
+
+    async def _receive(self):
+        # Returns (opcode, block) of the next packet from the client, or
+        # None on timeout. An error from the client ends the transfer.
+        try:
+            packet = await asyncio.wait_for(self.protocol.packets.get(), self.timeout)
+        except asyncio.TimeoutError:
+            return None
+        if len(packet) < 4:
+            return 0, 0
+        opcode, block = struct.unpack("!HH", packet[:4])
+        if opcode == ERROR:
+            message = packet[4:].split(b"\0", 1)[0].decode("ascii", "replace")
+            raise TransferAborted(f"Client sent error {block}: {message}")
+        return opcode, block
+
+    async def run(self):
+        if self.options:
+            oack = struct.pack("!H", OACK) + b"".join(
+                f"{name}\0{value}\0".encode("ascii") for name, value in self.options.items()
+            )
+            await self._acknowledged(lambda: self._send(oack), -1, 0)
+
+        # The last block is short, or empty when the size is a multiple of
+        # blksize, which is how the client knows the transfer is over.
+        last = len(self.data) // self.blksize + 1
+        base = 1
+        while base <= last:
+            end = min(base + self.windowsize - 1, last)
+
+            def send_window(base=base, end=end):
+                for number in range(base, end + 1):
+                    packet = self._block(number)
+                    self._send(packet)
+                    self.sent += len(packet) - 4
+
+            base = await self._acknowledged(send_window, base - 1, end) + 1
+
+    async def _acknowledged(self, send, acked, end):
+        # Sends and resends until the client acknowledges a block after
+        # acked, up to end. Block numbers wrap at 65536 so the 16 bit
+        # number is mapped back to the latest block it can stand for.
+        for _ in range(self.retries + 1):
+            send()
+            while True:
+                received = await self._receive()
+                if received is None:
+                    break
+                opcode, block = received
+                if opcode != ACK:
+                    continue
+                number = end - ((end - block) & 0xFFFF)
+                if number > acked:
+                    return number
+                # A duplicate of an older ACK, resending on those would
+                # double every packet from here on.
+        raise TFTPError(ERR_UNDEFINED, "Timed out")
+
+
+class TFTPServer(asyncio.DatagramProtocol):
+    """
+    A read only TFTP server (RFC 1350) for root, supporting the blksize,
+    tsize, timeout and windowsize options.
+
+    Each transfer runs on its own port as the protocol requires. While one
+    is in flight, repeats of the request that started it are ignored. Files
+    are memory mapped rather than read. Requests for autoexec.ipxe are
+    answered with menu() when menu is given instead of from disk.
+    """
+
+    def __init__(self, root, menu=None, max_blksize=MAX_BLKSIZE, max_windowsize=MAX_WINDOWSIZE, retries=MAX_RETRIES):
+        self.root = os.path.realpath(root)
+        self.menu = menu
+        self.max_blksize = max_blksize
+        self.max_windowsize = max_windowsize
+        self.retries = retries
+        self.transport = None
+        # In flight transfers by (client address, filename)
+        self.transfers = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            key = (addr, parse_request(data)[1])
+        except (TFTPError, struct.error):
+            # Answered with an error by _serve
+            key = (addr, None)
+        if key in self.transfers:
+            # Clients send their request again when the first DATA packet is
+            # slow to arrive. A second transfer would reach them from a TID
+            # they do not know.
+            logger.debug(f"TFTP ignoring a repeated request for {key[1]} from {addr[0]}.")
+            return
+        task = asyncio.get_running_loop().create_task(self._serve(data, addr))
+        self.transfers[key] = task
+        task.add_done_callback(lambda _: self.transfers.pop(key, None))
+
+    async def _serve(self, packet, client):
+        loop = asyncio.get_running_loop()
+        local_host = self.transport.get_extra_info("sockname")[0]
+        transport, protocol = await loop.create_datagram_endpoint(
+            lambda: _TransferProtocol(client), local_addr=(local_host, 0)
+        )
+        mapped = view = None
+        filename = None
+        try:
+            opcode, filename, mode, options = parse_request(packet)
+            if opcode == WRQ:
+                raise TFTPError(ERR_ACCESS, "This server is read only")
+            if opcode != RRQ:
+                raise TFTPError(ERR_ILLEGAL, "Illegal TFTP operation")
+            if mode not in ("octet", "netascii"):
+                raise TFTPError(ERR_ILLEGAL, f"Unsupported mode {mode}")
+
+            if self.menu is not None and filename.lstrip("/") == MENU_NAME:
+                data = self.menu()
+                data = data if isinstance(data, bytes) else data.encode("utf-8")
+            else:
+                path = resolve(self.root, filename)
+                try:
+                    with open(path, "rb") as f:
+                        size = os.fstat(f.fileno()).st_size
+                        # An empty file can not be mapped.
+                        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+                except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+                    raise TFTPError(ERR_NOT_FOUND, "File not found")
+                except PermissionError:
+                    raise TFTPError(ERR_ACCESS, "Access violation")
+                if size:
+                    mapped = data
+                    data = view = memoryview(mapped)
+            if mode == "netascii":
+                data = bytes(data).replace(b"\r", b"\r\0").replace(b"\n", b"\r\n")
+
+            accepted = negotiate_options(options, len(data), self.max_blksize, self.max_windowsize)
+            logger.info(f"TFTP sending {filename} to {client[0]} with {accepted or 'no options'}.")
+            transfer = _Transfer(protocol, data, filename, accepted, self.retries)
+            try:
+                await transfer.run()
+            finally:
+                tftp_bytes.inc(amount=transfer.sent)
+            tftp_transfers.inc("ok")
+        except TransferAborted as e:
+            logger.info(f"TFTP transfer of {filename} to {client[0]} aborted: {e}")
+            tftp_transfers.inc("aborted")
+        except TFTPError as e:
+            logger.info(f"TFTP transfer of {filename} to {client[0]} failed: {e}")
+            tftp_transfers.inc("error")
+            transport.sendto(error_packet(e.code, str(e)), client)
+        except Exception as e:
+            logger.error(f"!!! TFTP transfer of {filename} to {client[0]} failed: {e}")
+            tftp_transfers.inc("error")
+            transport.sendto(error_packet(ERR_UNDEFINED, "Internal error"), client)
+        finally:
+            transport.close()
+            if mapped is not None:
+                # The view has to be released before the map can be closed.
+                view.release()
+                try:
+                    mapped.close()
+                except BufferError:
+                    pass
+
+
+async def serve_tftp(root, host="0.0.0.0", port=6969, menu=None, **kwargs):
+    """
+    Runs a TFTPServer for root on host and port until cancelled.
+    """
+    loop = asyncio.get_running_loop()
+    transport, server = await loop.create_datagram_endpoint(
+        lambda: TFTPServer(root, menu, **kwargs), local_addr=(host, port)
+    )
+    logger.info(f"Serving {root} over TFTP on {host}:{port}.")
+    try:
+        await asyncio.Future()
+    finally:
+        transport.close()
+
+
+def start_tftp_thread(root, port=6969, menu=None, host="0.0.0.0"):
+    """
+    Starts the built in TFTP server on its own event loop in a daemon thread.
+    """
+    def run():
+        try:
+            asyncio.run(serve_tftp(root, host, port, menu))
+        except OSError as e:
+            logger.error(f"[!] TFTP server failed to start: {e}")
+
+    thread = threading.Thread(target=run, name="crispin-tftp", daemon=True)
+    thread.start()
+    return thread
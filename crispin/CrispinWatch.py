@@ -0,0 +1,254 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import threading
+import time
+from crispin.CrispinAPI import render_cache
+from crispin.CrispinCache import depends_on
+from crispin.CrispinGenerate import recipe_cache
+from crispin.CrispinCatalog import answers_catalog
+from crispin.CrispinIPXE import catalog_menu
+from crispin._util import logger
+
+# inotify(7) event masks
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+WATCH_MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+    | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+)
+_event = struct.Struct("iIII")
+
+
+class Inotify:
+    """
+    Minimal inotify binding over ctypes, reporting which watched directories
+    saw a change.
+    """
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._dirs = {}
+
+    def watch(self, directory):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd >= 0:
+            self._dirs[wd] = directory
+
+    def wait(self, timeout):
+        """
+        Blocks for up to timeout seconds and returns the set of directories
+        that changed. None means events were lost and everything should be
+        rescanned.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+        # Editors and cp write in bursts, let them settle into one batch
+        time.sleep(0.2)
+        changed = set()
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = _event.unpack_from(data, offset)
+                offset += _event.size + length
+                if mask & IN_Q_OVERFLOW:
+                    return None
+                if wd in self._dirs:
+                    changed.add(self._dirs[wd])
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    self._dirs.pop(wd, None)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class CookbookWatcher:
+    """
+    Keeps an in-memory view of a cookbook and reacts when it changes on disk.
+
+    The answers, recipes and templates directories are watched with inotify
+    on Linux and polled everywhere else. When a file changes only the
+    affected answers are re-parsed into the answers catalog, autoexec.ipxe is
+    rewritten and the compiled and rendered caches that were built from the
+    file are dropped.
+    """
+
+    def __init__(self, cookbook_dir, hostname, ipxe_dir=None, interval=2.0, mirror=False):
+        self.cookbook_dir = os.path.abspath(cookbook_dir)
+        self.hostname = hostname
+        self.mirror = mirror
+        self.ipxe_dir = ipxe_dir
+        self.interval = interval
+        self.answers_dir = os.path.join(self.cookbook_dir, "answers")
+        self.roots = [
+            self.answers_dir,
+            os.path.join(self.cookbook_dir, "recipes"),
+            os.path.join(self.cookbook_dir, "templates"),
+        ]
+        self.menu = None
+        self.catalog = answers_catalog(self.cookbook_dir)
+        self._snapshot = {}
+        self._inotify = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def load(self):
+        """
+        Scans the whole cookbook, builds the menu and writes autoexec.ipxe.
+        """
+        self._snapshot = self._scan(self.roots)
+        self.catalog.refresh()
+        self._update_menu()
+        return self.menu
+
+    def _is_answer(self, path):
+        return os.path.dirname(path) == self.answers_dir and path.endswith(".json")
+
+    def _scan(self, directories):
+        snapshot = {}
+        for directory in directories:
+            for root, dirs, files in os.walk(directory):
+                if self._inotify is not None:
+                    self._inotify.watch(root)
+                for name in files:
+                    path = os.path.join(root, name)
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    snapshot[path] = (st.st_mtime_ns, st.st_size)
+        return snapshot
+
+    def refresh(self, directories=None):
+        """
+        Rescans directories (the whole cookbook by default) and applies
+        whatever changed since the last scan. Returns the changed paths.
+        """
+        if directories is None:
+            directories = self.roots
+        prefixes = tuple(os.path.join(d, "") for d in directories)
+        old = {p: v for p, v in self._snapshot.items() if p.startswith(prefixes)}
+        new = self._scan(directories)
+        changed = {p for p in old.keys() | new.keys() if old.get(p) != new.get(p)}
+        if not changed:
+            return changed
+
+        for path in old.keys() - new.keys():
+            del self._snapshot[path]
+        self._snapshot.update(new)
+        self._apply(changed)
+        return changed
+
+    def _apply(self, changed):
+        logger.info(f"Cookbook changed: {sorted(changed)}")
+        # Only the answers files that changed are parsed again. A request
+        # may have re-parsed one already, so the menu is rebuilt either way.
+        answers_changed = any(self._is_answer(path) for path in changed)
+        if answers_changed:
+            self.catalog.refresh()
+
+        recipe_cache.invalidate(lambda _, compiled: depends_on(compiled.fingerprint, changed))
+        render_cache.invalidate(lambda _, rendered: depends_on(rendered.fingerprint, changed))
+
+        if answers_changed:
+            self._update_menu()
+
+    def _update_menu(self):
+        self.menu = catalog_menu(self.catalog, self.hostname, self.mirror)
+        if self.ipxe_dir is not None:
+            write_menu(self.menu, self.ipxe_dir)
+
+    def start(self):
+        if sys.platform.startswith("linux"):
+            try:
+                self._inotify = Inotify()
+                self._inotify.watch(self.cookbook_dir)
+            except OSError as e:
+                logger.warning(f"inotify unavailable, polling the cookbook instead: {e}")
+        if self.menu is None:
+            self.load()
+        elif self._inotify is not None:
+            self._scan(self.roots)
+        self._thread = threading.Thread(target=self._run, name="crispin-watch", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if self._inotify is None:
+                    self._stop.wait(self.interval)
+                    self.refresh()
+                    continue
+                changed_dirs = self._inotify.wait(self.interval)
+                if changed_dirs is None or self.cookbook_dir in changed_dirs:
+                    self.refresh()
+                elif changed_dirs:
+                    self.refresh(changed_dirs)
+            except Exception as e:
+                logger.error(f"!!! Cookbook watcher failed to refresh: {e}")
+
+
+def write_menu(menu, ipxe_dir):
+    """
+    Atomically replaces autoexec.ipxe in ipxe_dir with menu.
+    """
+    path = os.path.join(ipxe_dir, "autoexec.ipxe")
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(menu)
+    os.chmod(tmp_path, 0o777) #Octal bby
+    os.replace(tmp_path, path)
+
+
+class MenuFile:
+    """
+    The autoexec.ipxe in ipxe_dir as written by a CookbookWatcher in another
+    process, read again only when it is replaced.
+    """
+
+    def __init__(self, ipxe_dir):
+        self.path = os.path.join(ipxe_dir, "autoexec.ipxe")
+        self._identity = None
+        self._menu = None
+        self._lock = threading.Lock()
+
+    def read(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return self._menu
+        identity = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if identity != self._identity:
+            with self._lock:
+                if identity != self._identity:
+                    with open(self.path, "r") as f:
+                        self._menu = f.read()
+                    self._identity = identity
+        return self._menu
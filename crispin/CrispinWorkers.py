@@ -0,0 +1,169 @@
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from crispin._util import logger
+
+# Seconds a worker gets to finish the requests it has after SIGTERM before
+# it is killed.
+SHUTDOWN_GRACE = 30
+# Seconds a worker gets to start listening.
+START_TIMEOUT = 30
+# Workers exiting sooner than this after starting failed to start. After
+# MAX_FAILED_STARTS of those in a row the server gives up.
+MIN_UPTIME = 5
+MAX_FAILED_STARTS = 5
+
+
+class _Worker:
+
+    def __init__(self, number, process, ready):
+        self.number = number
+        self.process = process
+        self.ready = ready
+        self.started = time.monotonic()
+        self.deadline = None
+
+    def listening(self, timeout):
+        try:
+            return self.ready.poll(timeout) and self.ready.recv()
+        except EOFError:
+            # Exited before it was listening
+            return False
+
+
+class WorkerSupervisor:
+    """
+    Runs target(*args, ready) in workers processes and keeps them running.
+    Each worker sends on the ready pipe once it is listening.
+
+    Workers are spawned rather than forked, the supervisor runs threads of
+    its own and a forked child could inherit a lock one of them held. A
+    worker that dies is replaced. SIGTERM or SIGINT stop every worker and
+    give each SHUTDOWN_GRACE seconds to finish what it is serving. SIGHUP
+    restarts the workers one at a time, each replacement listening before
+    the worker it replaces is stopped, so the port is never left without
+    one.
+    """
+
+    def __init__(self, workers: int, target, args=()):
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+        self.count = workers
+        self.target = target
+        self.args = args
+        self.workers = []
+        self._retiring = []
+        self._context = multiprocessing.get_context("spawn")
+        self._stopping = False
+        self._restarting = False
+
+    def _spawn(self, number):
+        ready, ready_sender = self._context.Pipe(duplex=False)
+        # Not a daemon, workers start process pools of their own.
+        process = self._context.Process(target=self.target, args=(*self.args, ready_sender), name=f"crispin-worker-{number}")
+        process.start()
+        ready_sender.close()
+        logger.info(f"Started worker {number} as pid {process.pid}.")
+        return _Worker(number, process, ready)
+
+    def _retire(self, worker):
+        # Asks a worker to stop and kills it if it has not within the grace.
+        if worker.process.is_alive():
+            worker.process.terminate()
+        worker.deadline = time.monotonic() + SHUTDOWN_GRACE
+        self._retiring.append(worker)
+
+    def _reap(self):
+        for worker in list(self._retiring):
+            if not worker.process.is_alive():
+                worker.process.join()
+                self._retiring.remove(worker)
+            elif time.monotonic() > worker.deadline:
+                logger.warning(f"Worker pid {worker.process.pid} did not stop in {SHUTDOWN_GRACE}s, killing it.")
+                worker.process.kill()
+
+    def _rolling_restart(self):
+        logger.info("Restarting workers.")
+        for i, old in enumerate(list(self.workers)):
+            if self._stopping:
+                return
+            new = self._spawn(old.number)
+            if not new.listening(START_TIMEOUT):
+                logger.error(f"!!! Worker {new.number} did not start listening, keeping the running workers.")
+                self._retire(new)
+                return
+            self.workers[i] = new
+            self._retire(old)
+            self._reap()
+
+    def _on_stop(self, signum, frame):
+        self._stopping = True
+
+    def _on_restart(self, signum, frame):
+        self._restarting = True
+
+    def run(self):
+        """
+        Starts the workers and supervises them until SIGTERM or SIGINT, or
+        until they keep failing to start. Returns True on a clean stop.
+        """
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_restart)
+
+        self.workers = [self._spawn(number) for number in range(self.count)]
+        failed_starts = 0
+        clean = True
+        while not self._stopping:
+            time.sleep(0.5)
+            if self._restarting:
+                self._restarting = False
+                self._rolling_restart()
+            for i, worker in enumerate(self.workers):
+                if worker.process.is_alive():
+                    continue
+                worker.process.join()
+                if self._stopping:
+                    # A SIGTERM sent to the whole process group can stop a
+                    # worker before the supervisor's handler has run.
+                    break
+                if time.monotonic() - worker.started < MIN_UPTIME:
+                    failed_starts += 1
+                else:
+                    failed_starts = 0
+                if failed_starts >= MAX_FAILED_STARTS:
+                    logger.error("!!! Workers keep exiting straight after starting, giving up.")
+                    self._stopping = True
+                    clean = False
+                    break
+                logger.warning(f"Worker {worker.number} (pid {worker.process.pid}) exited with {worker.process.exitcode}, starting a new one.")
+                self.workers[i] = self._spawn(worker.number)
+            self._reap()
+
+        logger.info("Stopping workers.")
+        for worker in self.workers:
+            self._retire(worker)
+        self.workers = []
+        while self._retiring:
+            time.sleep(0.1)
+            self._reap()
+        return clean
+
+
+def watch_parent(on_orphaned, interval=1.0):
+    """
+    Calls on_orphaned from a daemon thread once the process that started
+    this one is gone, so workers do not outlive a supervisor that was
+    killed outright.
+    """
+    parent = os.getppid()
+
+    def run():
+        while os.getppid() == parent:
+            time.sleep(interval)
+        logger.warning("Supervisor went away, stopping.")
+        on_orphaned()
+
+    threading.Thread(target=run, name="crispin-watch-parent", daemon=True).start()
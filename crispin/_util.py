@@ -36,8 +36,8 @@ def dict_to_dot(d, parent_key=''):
             items.append(c_key)
     return items
 
-def dot_to_dict(d_list, parent={}):
-    res = parent
+def dot_to_dict(d_list, parent=None):
+    res = {} if parent is None else parent
 
     for item in d_list:
         keys = item.split('.')
@@ -47,7 +47,8 @@ def dot_to_dict(d_list, parent={}):
         # c_res is pointer to current dict, this builds the nested dicts
         # by moving the c_res pointer for each dot in the string
         for sub_key in keys[:-1]: # Ensure that the last value is not treated as a dict by trimming with :-1
-            if sub_key not in c_res:
+            # A bare "a" seen before "a.b" leaves a placeholder to replace
+            if not isinstance(c_res.get(sub_key), dict):
                 c_res[sub_key] = {}
             c_res = c_res[sub_key] # Move down the dict structure for the next iteration
 
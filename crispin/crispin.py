@@ -2,13 +2,15 @@
 
 import argparse, logging, sys
 import traceback
+from contextlib import nullcontext
 from pathlib import Path
 from crispin.CrispinGenerate import (
-    generate_template,
+    compile_recipe,
     generate_empty_answers,
     write_file,
     generate_kickstart,
 )
+from crispin.CrispinProfile import profiled
 from crispin._util import logger, set_log_level
 
 def main():
@@ -16,7 +18,7 @@ def main():
     parser = argparse.ArgumentParser()
     # Required arguments
     subparser = parser.add_subparsers(
-        help="Choose a command: generate or serve.", dest="command"
+        help="Choose a command: generate, compile or serve.", dest="command"
     )
     serve_parser = subparser.add_parser("serve", help="Start the Crispin API server")
     serve_parser.add_argument(
@@ -33,19 +35,132 @@ def main():
         help="The path to the directory containing vmlinuz and initrd.img.",
         required=True,
     )
+    serve_parser.add_argument(
+        "--threads",
+        type=int,
+        help="(Optional default: 16) Number of threads handling http requests.",
+        default=16,
+    )
+    serve_parser.add_argument(
+        "--queue-depth",
+        type=int,
+        help="(Optional default: 64) Number of connections that may wait for a free thread before new ones are turned away with a 503.",
+        default=64,
+    )
+    serve_parser.add_argument(
+        "--max-bulk",
+        type=int,
+        help="(Optional default: half of --threads) Number of vmlinuz and initrd.img transfers sent at once. A few more wait up to --admission-wait seconds, the rest get a 503.",
+        default=None,
+    )
+    serve_parser.add_argument(
+        "--max-control",
+        type=int,
+        help="(Optional default: --threads) Number of kickstart, menu and other requests handled at once.",
+        default=None,
+    )
+    serve_parser.add_argument(
+        "--admission-wait",
+        type=float,
+        help="(Optional default: 10) Seconds a request waits for a free slot before it gets a 503.",
+        default=10.0,
+    )
+    serve_parser.add_argument(
+        "--image-bandwidth",
+        type=float,
+        help="(Optional) Combined Mbit/s of all vmlinuz and initrd.img transfers, shared fairly between them. Unlimited by default.",
+        default=None,
+    )
+    serve_parser.add_argument(
+        "--mirror",
+        action="store_true",
+        help="(Optional) Boot hosts whose source is an http repo from a local cache of its vmlinuz, initrd.img and install.img instead of the upstream mirror. Each is downloaded once.",
+        default=False,
+    )
+    serve_parser.add_argument(
+        "--mirror-dir",
+        type=str,
+        help="(Optional default: COOKBOOK_DIR/.crispin/mirror) Where --mirror keeps the cached files.",
+        default=None,
+    )
+    serve_parser.add_argument(
+        "--mirror-size",
+        type=float,
+        help="(Optional default: 20) GiB of disk --mirror may use. The least recently used files are removed beyond that.",
+        default=20,
+    )
+    serve_parser.add_argument(
+        "--batch-jobs",
+        type=int,
+        help="(Optional default: number of CPUs) Number of processes rendering POST /crispin/batch requests.",
+        default=None,
+    )
+    serve_parser.add_argument(
+        "--workers",
+        type=int,
+        help="(Optional default: 1) Number of server processes sharing the port, each with --threads threads. Use up to one per core to render kickstarts on every core. /metrics only reports the worker that answers the scrape.",
+        default=1,
+    )
+    serve_parser.add_argument(
+        "--tftp",
+        choices=("in.tftpd", "builtin", "off"),
+        help="(Optional default: in.tftpd) TFTP server for the ipxe dir. builtin serves it from crispin itself with blksize, tsize and windowsize support and needs no in.tftpd.",
+        default="in.tftpd",
+    )
+    serve_parser.add_argument(
+        "--tftp-port",
+        type=int,
+        help="(Optional default: 6969) Port the TFTP server listens on.",
+        default=6969,
+    )
+    serve_parser.add_argument(
+        "--keepalive-timeout",
+        type=float,
+        help="(Optional default: 5) Seconds an idle keep-alive connection is held open waiting for the next request.",
+        default=5,
+    )
+    serve_parser.add_argument(
+        "--keepalive-requests",
+        type=int,
+        help="(Optional default: 100) Number of requests served on one connection before it is closed.",
+        default=100,
+    )
+    serve_parser.add_argument(
+        "--profile-dir",
+        type=str,
+        help="(Optional) Enables profiling of kickstart requests. cProfile stats are written here named after the recipe and answers.",
+        default=None,
+    )
+    serve_parser.add_argument(
+        "--profile-rate",
+        type=float,
+        help="(Optional default: 0) Fraction of kickstart requests to profile with --profile-dir. Requests with the header X-Crispin-Profile: 1 are always profiled.",
+        default=0.0,
+    )
+    serve_parser.add_argument(
+        "--prerender",
+        action="store_true",
+        help="(Optional) Render the kickstart of every answers file in the background at startup so the first requests are served from memory. Answers files that fail to render are reported.",
+        default=False,
+    )
+    serve_parser.add_argument(
+        "--no-watch",
+        action="store_true",
+        help="(Optional) Do not watch the cookbook for changes. New answer files will not show up in the iPXE menu until a restart.",
+        default=False,
+    )
 
     generate_parser = subparser.add_parser(
         "generate", help="Set options for generating answers, kickstarts, and ISOs."
     )
     generate_parser.add_argument(
-        "-r", "--recipe", type=str, help="The path of the chosen recipe.", required=True
+        "-r", "--recipe", type=str, help="The path of the chosen recipe. Required unless --batch is used."
     )
     generate_parser.add_argument(
         "-n",
         "--name",
         type=str,
-        help="Name of the generated kickstart or answer file.",
-        required=True,
+        help="Name of the generated kickstart or answer file. Required unless --batch is used.",
     )
     generate_parser.add_argument(
         "-l",
@@ -65,6 +180,12 @@ def main():
     arg_group.add_argument(
         "-a", "--answers", type=str, help="Path to json answers to fill in kickstart."
     )
+    arg_group.add_argument(
+        "-b",
+        "--batch",
+        type=str,
+        help="Path to a cookbook answers dir. Generates a kickstart named after each answers file using the recipe in its metadata.",
+    )
 
     # Optional arguments
     generate_parser.add_argument(
@@ -82,6 +203,38 @@ def main():
         default=None,
     )
 
+    generate_parser.add_argument(
+        "--profile",
+        type=str,
+        help="(Optional) Write cProfile stats of generating the kickstart or answer file to this path. Not supported with --batch.",
+        default=None,
+    )
+    generate_parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="(Optional default: number of CPUs) Number of processes rendering kickstarts with --batch.",
+        default=None,
+    )
+
+    compile_parser = subparser.add_parser(
+        "compile", help="Compile every recipe in a cookbook ahead of time."
+    )
+    compile_parser.add_argument(
+        "-c",
+        "--cookbook-dir",
+        type=str,
+        help="The path to the cookbook directory.",
+        required=True,
+    )
+    compile_parser.add_argument(
+        "-l",
+        "--logging",
+        action="store_true",
+        help="(Optional) Also compile every recipe with logging enabled, as used by generate -l.",
+        default=False,
+    )
+
     parser.add_argument(
         "-v",
         "--verbose",
@@ -120,8 +273,59 @@ def main():
 
     if args.command == 'serve':
         from crispin.CrispinServe import run
-        run(cookbook_dir=args.cookbook_dir, ipxe_dir=args.ipxe_dir)
+        run(
+            cookbook_dir=args.cookbook_dir,
+            ipxe_dir=args.ipxe_dir,
+            threads=args.threads,
+            queue_depth=args.queue_depth,
+            watch=not args.no_watch,
+            profile_dir=args.profile_dir,
+            profile_rate=args.profile_rate,
+            prerender=args.prerender,
+            keepalive_timeout=args.keepalive_timeout,
+            keepalive_requests=args.keepalive_requests,
+            tftp=args.tftp,
+            tftp_port=args.tftp_port,
+            max_bulk=args.max_bulk,
+            max_control=args.max_control,
+            admission_wait=args.admission_wait,
+            image_bandwidth=args.image_bandwidth * 1e6 / 8 if args.image_bandwidth else None,
+            mirror=args.mirror,
+            mirror_dir=args.mirror_dir,
+            mirror_size=int(args.mirror_size * 1024 ** 3),
+            batch_jobs=args.batch_jobs,
+            workers=args.workers,
+        )
         sys.exit(0)
+    if args.command == 'compile':
+        from crispin.CrispinStore import compile_cookbook
+        variants = (False, True) if args.logging else (False,)
+        try:
+            stored, failures = compile_cookbook(args.cookbook_dir, variants)
+        except OSError as e:
+            print(f"!!! Can not write the compiled store: {e}")
+            sys.exit(1)
+        for (recipe, ks_logging), path in sorted(stored.items()):
+            print(f"Compiled recipe {recipe}{' with logging' if ks_logging else ''} to {path}.")
+        for (recipe, ks_logging), e in sorted(failures.items()):
+            print(f"!!! Failed to compile recipe {recipe}: {e}")
+        sys.exit(1 if failures else 0)
+    if args.batch:
+        if args.profile:
+            generate_parser.error("--profile can not be used with --batch")
+        from crispin.CrispinBatch import generate_batch
+        written, failures = generate_batch(
+            args.batch, args.output_dir, args.jobs, args.logging, args.template_dir
+        )
+        for answer_file, path in sorted(written.items()):
+            print(f"Wrote the kickstart for {answer_file} to {path}.")
+        for answer_file, e in sorted(failures.items()):
+            print(f"!!! Failed to generate a kickstart for {answer_file}: {e}")
+        sys.exit(1 if failures else 0)
+
+    if args.recipe is None or args.name is None:
+        generate_parser.error("the following arguments are required: -r/--recipe, -n/--name")
+
     match args.template_dir:
         case None:
             template_path = Path(args.recipe).parents[1] / "templates"
@@ -129,24 +333,26 @@ def main():
             logger.info(
                 "Not using a cookbook! Tread with caution. See crispin README for details."
             )
-            template_path = Path(args.template_path)
+            template_path = Path(args.template_dir)
 
+    profile = profiled(args.profile) if args.profile else nullcontext()
     try:
-        ks_template = generate_template(args.recipe, template_path, args.logging)
-
-        match args.generate_answers:
-            case True:
-                generated_answers = generate_empty_answers(ks_template)
-                abs_path = write_file(
-                    generated_answers, args.output_dir, args.name + ".json"
-                )
-                logger.info(f"Wrote answers for recipe {args.recipe} to {abs_path}.")
-                print(f"Wrote answers for recipe {args.recipe} to {abs_path}.")
-            case _:
-                generated_ks = generate_kickstart(ks_template, args.answers)
-                abs_path = write_file(generated_ks, args.output_dir, args.name + ".ks")
-                logger.info(f"Wrote the kickstart for recipe {args.recipe} to {abs_path}.")
-                print(f"Wrote the kickstart for recipe {args.recipe} to {abs_path}.")
+        with profile:
+            ks_template = compile_recipe(args.recipe, template_path, args.logging)
+
+            match args.generate_answers:
+                case True:
+                    generated_answers = generate_empty_answers(ks_template)
+                    abs_path = write_file(
+                        generated_answers, args.output_dir, args.name + ".json"
+                    )
+                    logger.info(f"Wrote answers for recipe {args.recipe} to {abs_path}.")
+                    print(f"Wrote answers for recipe {args.recipe} to {abs_path}.")
+                case _:
+                    generated_ks = generate_kickstart(ks_template, args.answers)
+                    abs_path = write_file(generated_ks, args.output_dir, args.name + ".ks")
+                    logger.info(f"Wrote the kickstart for recipe {args.recipe} to {abs_path}.")
+                    print(f"Wrote the kickstart for recipe {args.recipe} to {abs_path}.")
     except Exception as e:
         logger.error(f"!!! {e}")
         traceback.print_exc()
@@ -9,5 +9,8 @@ setup(
     entry_points = {
         'console_scripts': ['crispin = crispin.crispin:main']
     },
-    install_requires = ['Jinja2>=3.1.3','MarkupSafe==2.1.3', 'python-dotenv>=1.0.1', 'pygvariant>=0.4.1']
+    install_requires = ['Jinja2>=3.1.3','MarkupSafe==2.1.3', 'python-dotenv>=1.0.1', 'pygvariant>=0.4.1'],
+    extras_require = {
+        'zstd': ['zstandard>=0.22.0']
+    }
 )